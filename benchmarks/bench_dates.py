@@ -0,0 +1,64 @@
+""" Compares the RFC 1123 codec behind utils.date_to_str/str_to_date with
+the strftime/strptime functions it replaced, checking that they agree.
+
+    python benchmarks/bench_dates.py
+"""
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'cyclone-rest-server'))
+
+import dates  # noqa: E402
+from utils import config, date_to_str, str_to_date  # noqa: E402
+
+
+def strftime_date_to_str(date):
+    return datetime.datetime.strftime(date, config.DATE_FORMAT)
+
+
+def strptime_str_to_date(string):
+    return datetime.datetime.strptime(string, config.DATE_FORMAT)
+
+
+def bench(func, args, repeat=5):
+    """ Returns the best time per call over `args`, in microseconds. """
+    def run():
+        for arg in args:
+            func(arg)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(args) * 1e6
+
+
+def main(count=20000):
+    start = datetime.datetime(2013, 5, 1, 12, 30, 15, 250000)
+    # a page worth of documents written over a few minutes, rendered again
+    # and again, and a handful of distinct If-Modified-Since values.
+    values = [start + datetime.timedelta(seconds=i // 2, microseconds=i)
+              for i in range(1000)] * (count // 1000)
+    headers = [strftime_date_to_str(v) for v in values[:20]] * (count // 20)
+
+    for value in values[:1000]:
+        assert date_to_str(value) == strftime_date_to_str(value)
+    for header in headers[:20]:
+        assert str_to_date(header) == strptime_str_to_date(header)
+
+    for label, old, new, args in (
+            ('date_to_str', strftime_date_to_str, date_to_str, values),
+            ('str_to_date', strptime_str_to_date, str_to_date, headers)):
+        before = bench(old, args)
+        dates._formatted.clear()
+        dates._parsed.clear()
+        after = bench(new, args)
+        print('%-12s %8.2f us -> %6.2f us %6.1fx' % (label, before, after,
+                                                     before / after))
+
+    # cold caches, e.g. an export going through every document once.
+    dates.FORMAT_CACHE_SIZE = 0
+    print('%-12s %8.2f us' % ('format miss', bench(date_to_str, values)))
+    print('%-12s %8.2f us' % ('parse miss', bench(dates._parse, headers)))
+
+
+if __name__ == '__main__':
+    main()
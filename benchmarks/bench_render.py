@@ -0,0 +1,79 @@
+""" Compares the JSON rendering engines against the original
+``json.dumps(cls=APIEncoder, sort_keys=True)`` renderer on a typical page of
+items, checking that they all produce the same JSON document.
+
+    python benchmarks/bench_render.py [page size]
+"""
+import datetime
+import json
+import os
+import sys
+import timeit
+
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'cyclone-rest-server'))
+
+from render import APIEncoder, JSONRenderer  # noqa: E402
+from render import OrjsonRenderer, UjsonRenderer  # noqa: E402
+import render  # noqa: E402
+
+
+def sample_page(size):
+    now = datetime.datetime(2013, 5, 1, 12, 30, 15)
+    items = []
+    for i in range(size):
+        items.append({
+            '_id': ObjectId(),
+            'user': 'user%d' % i,
+            'status': 'queued' if i % 3 else 'done',
+            'attempts': i % 5,
+            'tags': ['nightly', 'build'],
+            'payload': {'path': '/var/jobs/%d' % i, 'weight': i / 3.0},
+            'updated': now + datetime.timedelta(seconds=i),
+            'created': now,
+            'etag': '%040x' % i,
+        })
+    return {'items': items,
+            'links': {'parent': {'title': 'home', 'href': '127.0.0.1:5000'}}}
+
+
+def original(data):
+    return json.dumps(data, cls=APIEncoder, sort_keys=True)
+
+
+def bench(func, number, repeat=5):
+    """ Returns the best time per call, in microseconds. """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) \
+        / number * 1e6
+
+
+def main(size=50, number=200):
+    data = sample_page(size)
+    expected = original(data)
+
+    engines = [JSONRenderer()]
+    if render.orjson is not None:
+        engines.append(OrjsonRenderer())
+    if render.ujson is not None:
+        engines.append(UjsonRenderer())
+
+    baseline = bench(lambda: original(data), number)
+    print('%d items per page' % size)
+    print('%-20s %10.1f us' % ('APIEncoder', baseline))
+
+    for engine in engines:
+        output = engine.render(data)
+        assert json.loads(output.decode('utf-8')) == json.loads(expected), \
+            '%s renders a different document' % engine.name
+        if engine.name == 'json':
+            assert output == expected.encode('utf-8')
+        for sort_keys in (True, False):
+            t = bench(lambda: engine.render(data, sort_keys), number)
+            label = '%s%s' % (engine.name, '' if sort_keys else ' (unsorted)')
+            print('%-20s %10.1f us %6.2fx' % (label, t, baseline / t))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,95 @@
+""" Measures the throughput of the compiled schema validators, in documents
+per second, on valid and invalid job documents. Compiling the schema for
+every document shows what caching the validators saves, and Cerberus is
+measured too when it is installed.
+
+    python benchmarks/bench_validation.py [number of documents]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'cyclone-rest-server'))
+
+from validation import Validator  # noqa: E402
+
+try:
+    import cerberus
+except ImportError:
+    cerberus = None
+
+SCHEMA = {
+    'firstname': {'type': 'string', 'minlength': 1, 'maxlength': 10,
+                  'required': True},
+    'lastname': {'type': 'string', 'minlength': 1, 'maxlength': 15},
+    'status': {'type': 'string', 'allowed': ['queued', 'running', 'done'],
+               'default': 'queued'},
+    'priority': {'type': 'integer', 'min': 0, 'max': 10, 'default': 5},
+    'tags': {'type': 'list', 'schema': {'type': 'string'}},
+    'payload': {'type': 'dict', 'schema': {
+        'path': {'type': 'string', 'regex': '/[a-z/0-9]+'},
+        'weight': {'type': 'number', 'nullable': True},
+    }},
+}
+DEFAULTS = set(field for field, definition in SCHEMA.items()
+               if 'default' in definition)
+
+
+def sample_documents(count):
+    documents = []
+    for i in range(count):
+        document = {'firstname': 'user%d' % (i % 1000),
+                    'tags': ['nightly', 'build'],
+                    'payload': {'path': '/var/jobs/%d' % i, 'weight': i / 3.0}}
+        if i % 2:
+            document['lastname'] = 'smith'
+            document['priority'] = i % 10
+        documents.append(document)
+    return documents
+
+
+def invalid_documents(count):
+    documents = sample_documents(count)
+    for i, document in enumerate(documents):
+        document['priority'] = 20
+        document['unknown'] = i
+    return documents
+
+
+def bench(validate, documents, repeat=5):
+    """ Returns the best throughput, in documents per second. Documents are
+    copied as the validators set their default values.
+    """
+    def run():
+        for document in documents:
+            validate(dict(document))
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return len(documents) / best
+
+
+def main(count=20000):
+    compiled = Validator(SCHEMA, defaults=DEFAULTS)
+    valid = sample_documents(count)
+    invalid = invalid_documents(count)
+    assert not compiled.validate(dict(valid[1]))
+    assert set(compiled.validate(dict(invalid[1]))) == \
+        set(['priority', 'unknown'])
+
+    validators = [
+        ('compiled', compiled.validate),
+        ('compiled per document',
+         lambda document: Validator(SCHEMA, defaults=DEFAULTS).validate(
+             document)),
+    ]
+    if cerberus is not None:
+        validators.append(('cerberus', cerberus.Validator(SCHEMA).validate))
+
+    print('%d documents' % count)
+    for label, validate in validators:
+        print('%-24s %10.0f docs/s valid %10.0f docs/s invalid' % (
+            label, bench(validate, valid), bench(validate, invalid)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
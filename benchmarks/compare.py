@@ -0,0 +1,54 @@
+""" Compares two result files of loadtest.py or micro.py, e.g. the runs of
+two commits.
+
+    python benchmarks/compare.py before.json after.json
+"""
+import json
+import sys
+
+# the figures worth comparing, by the end of their name.
+FIGURES = ('throughput', 'p50_ms', 'p99_ms', 'p999_ms', 'mean_ms',
+           'client_cpu_percent')
+
+
+def flatten(results, prefix=''):
+    """ Returns the numeric figures of results, by dotted name. """
+    figures = {}
+    for key, value in results.items():
+        name = prefix + key
+        if key == 'options':
+            continue
+        if isinstance(value, dict):
+            figures.update(flatten(value, name + '.'))
+        elif key == 'rss_kb':
+            pass
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if prefix.endswith('us_per_call.') or name.endswith(FIGURES):
+                figures[name] = value
+    for server, samples in results.get('rss_kb', {}).items():
+        values = [kb for _, kb in samples if kb is not None]
+        if values:
+            figures[prefix + 'rss_kb.%s.max' % server] = max(values)
+    return figures
+
+
+def main(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print('%s -> %s' % (before.get('commit', before_path),
+                        after.get('commit', after_path)))
+
+    old, new = flatten(before), flatten(after)
+    for name in sorted(set(old) & set(new)):
+        change = (new[name] - old[name]) / old[name] * 100 \
+            if old[name] else 0
+        print('%-40s %12.2f %12.2f %+8.1f%%' % (name, old[name], new[name],
+                                               change))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    main(*sys.argv[1:])
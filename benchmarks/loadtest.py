@@ -0,0 +1,548 @@
+""" Load test of the cyclone REST and SSE servers.
+
+Starts the servers on free local ports, the REST server with its in-memory
+data layer and the SSE server with its HTTP broker, so nothing else has to
+be running. Then drives them for a while and reports throughput, latency
+percentiles and the resident memory of the servers over time. Results are
+saved as JSON, to be compared across commits with compare.py.
+
+    python benchmarks/loadtest.py --concurrency=50 --duration=30 \\
+        --mix=list:50,item:30,conditional:10,bulk:10
+    python benchmarks/loadtest.py --target=sse --subscribers=500 --rate=200
+
+The REST requests are:
+
+- list: a page of the collection, ``GET /jobs?max_results=25&page=n``
+- item: ``GET /jobs/<id>``
+- conditional: ``GET /jobs/<id>`` with the item ETag in If-None-Match
+- bulk: ``POST /jobs`` of a JSON array of --bulk-size documents
+
+The SSE test opens --subscribers connections, publishes --rate messages
+per second through ``/publish`` and measures how long each message takes
+to reach every subscriber.
+
+The load generator is a single Twisted process: check the client CPU
+reported with the results, near 100% means it is the bottleneck.
+
+The servers are started with the Python running this script unless
+--python says otherwise; cyclone-sse has to be installed for the SSE test.
+"""
+from io import BytesIO
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.python import usage
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool
+from twisted.web.client import readBody
+from twisted.web.http_headers import Headers
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REST_DIR = os.path.join(ROOT, 'cyclone-rest-server')
+SSE_DIR = os.path.join(ROOT, 'cyclone_sse_server')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+OPERATIONS = ('list', 'item', 'conditional', 'bulk')
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["target", "t", "rest", "server to test: rest, sse or both"],
+        ["duration", "d", 20, "seconds of measured load", int],
+        ["warmup", None, 3, "seconds of load before measuring", int],
+        ["concurrency", "c", 20, "concurrent REST requests", int],
+        ["mix", "m", "list:50,item:30,conditional:10,bulk:10",
+         "weights of the REST requests"],
+        ["documents", None, 1000, "documents created before the test", int],
+        ["bulk-size", None, 50, "documents per bulk POST", int],
+        ["rest-args", None, "",
+         "extra arguments of the REST server, e.g. '--workers=4'"],
+        ["subscribers", "s", 200, "SSE subscriber connections", int],
+        ["rate", "r", 100, "SSE messages published per second", int],
+        ["rss-interval", None, 1.0,
+         "seconds between two samples of the servers memory", float],
+        ["python", None, sys.executable, "python running the servers"],
+        ["output", "o", None,
+         "results file, benchmarks/results/<commit>-<time>.json by default"],
+        ["seed", None, 0, "random seed", int],
+    ]
+
+    def postOptions(self):
+        if self['target'] not in ('rest', 'sse', 'both'):
+            raise usage.UsageError('unknown target %r' % self['target'])
+        mix = []
+        for weight in self['mix'].split(','):
+            name, _, value = weight.partition(':')
+            if name not in OPERATIONS:
+                raise usage.UsageError('unknown request %r' % name)
+            mix.append((name, int(value or 1)))
+        self['mix'] = mix
+
+
+class Latencies(object):
+    """ Every latency and status of a kind of request. Percentiles are
+    exact: a few million floats are no trouble.
+    """
+    def __init__(self):
+        self.values = []
+        self.statuses = {}
+
+    def record(self, latency, status):
+        self.values.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self, duration):
+        values = sorted(self.values)
+        result = {'count': len(values),
+                  'throughput': len(values) / float(duration),
+                  'statuses': dict((str(status), count) for status, count
+                                   in self.statuses.items())}
+        if values:
+            result['mean_ms'] = sum(values) / len(values) * 1000
+            result['max_ms'] = values[-1] * 1000
+            for name, percent in (('p50', 50), ('p99', 99),
+                                  ('p999', 99.9)):
+                index = min(len(values) - 1,
+                            int(len(values) * percent / 100.0))
+                result[name + '_ms'] = values[index] * 1000
+        return result
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, process, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with status %s'
+                               % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('server did not listen on port %d' % port)
+
+
+def start_server(args, cwd, port, log_path):
+    log_file = open(log_path, 'w')
+    process = subprocess.Popen(args, cwd=cwd, stdout=log_file,
+                               stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(port, process)
+    except Exception:
+        stop_server(process)
+        raise
+    return process
+
+
+def stop_server(process):
+    if process.poll() is None:
+        process.terminate()
+        deadline = time.time() + 10
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if process.poll() is None:
+            process.kill()
+
+
+def rss_kb(pid):
+    """ Returns the resident memory of a process and its children, in kB,
+    `None` where /proc isn't available.
+    """
+    pids = [pid]
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            pids.extend(int(child) for child in f.read().split())
+    except (IOError, OSError):
+        pass
+    total = 0
+    for p in pids:
+        try:
+            with open('/proc/%d/status' % p) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except (IOError, OSError):
+            if p == pid:
+                return None
+    return total
+
+
+class MemorySampler(object):
+    """ Samples the resident memory of server processes. """
+    def __init__(self, processes, interval):
+        self.processes = processes
+        self.samples = dict((name, []) for name in processes)
+        self.started = time.time()
+        self.loop = task.LoopingCall(self.sample)
+        self.loop.start(interval)
+
+    def sample(self):
+        elapsed = round(time.time() - self.started, 2)
+        for name, process in self.processes.items():
+            self.samples[name].append([elapsed, rss_kb(process.pid)])
+
+    def stop(self):
+        self.loop.stop()
+        return self.samples
+
+
+def body_producer(data):
+    return FileBodyProducer(BytesIO(data))
+
+
+class RestLoad(object):
+    """ Drives the REST server with a mix of requests. """
+    def __init__(self, options, base_url):
+        self.options = options
+        self.base_url = base_url
+        self.random = random.Random(options['seed'])
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = options['concurrency']
+        self.agent = Agent(reactor, pool=pool)
+        self.items = []
+        self.latencies = dict((name, Latencies()) for name in OPERATIONS)
+        self.recording = False
+        self.counter = 0
+
+        self.choices = []
+        for name, weight in options['mix']:
+            self.choices.extend([name] * weight)
+
+    def documents(self, count):
+        documents = []
+        for _ in range(count):
+            self.counter += 1
+            documents.append({'user': 'user%d' % self.counter,
+                              'status': 'queued',
+                              'attempts': self.counter % 5,
+                              'tags': ['nightly', 'build']})
+        return documents
+
+    @defer.inlineCallbacks
+    def request(self, method, path, headers=None, body=None):
+        headers = Headers(headers or {})
+        if body is not None:
+            headers.setRawHeaders(b'Content-Type', [b'application/json'])
+            body = body_producer(body)
+        response = yield self.agent.request(
+            method, (self.base_url + path).encode('ascii'), headers, body)
+        data = yield readBody(response)
+        defer.returnValue((response.code, data))
+
+    @defer.inlineCallbacks
+    def seed(self):
+        """ Creates the documents read by the item and list requests. """
+        left = self.options['documents']
+        while left > 0:
+            batch = self.documents(min(100, left))
+            left -= len(batch)
+            code, data = yield self.request(b'POST', '/jobs',
+                                            body=json.dumps(batch).encode())
+            if code != 201:
+                raise RuntimeError('seeding failed with status %d: %s'
+                                   % (code, data[:200]))
+            for item in json.loads(data.decode('utf-8'))['items']:
+                self.items.append((item['_id'], item['etag']))
+
+    def build(self, name):
+        if name == 'list':
+            pages = max(1, len(self.items) // 25)
+            return (b'GET', '/jobs?max_results=25&page=%d'
+                    % self.random.randint(1, pages), None, None)
+        id_, etag = self.random.choice(self.items)
+        if name == 'item':
+            return b'GET', '/jobs/%s' % id_, None, None
+        if name == 'conditional':
+            return (b'GET', '/jobs/%s' % id_,
+                    {b'If-None-Match': [('"%s"' % etag).encode('ascii')]},
+                    None)
+        body = json.dumps(self.documents(self.options['bulk-size']))
+        return b'POST', '/jobs', None, body.encode('utf-8')
+
+    @defer.inlineCallbacks
+    def worker(self, deadline):
+        while time.time() < deadline:
+            name = self.random.choice(self.choices)
+            method, path, headers, body = self.build(name)
+            started = time.time()
+            try:
+                code, _ = yield self.request(method, path, headers, body)
+            except Exception as e:
+                code = 'error: %s' % e.__class__.__name__
+            if self.recording:
+                self.latencies[name].record(time.time() - started, code)
+
+    @defer.inlineCallbacks
+    def run(self):
+        yield self.seed()
+        warmup, duration = self.options['warmup'], self.options['duration']
+        deadline = time.time() + warmup + duration
+
+        def record():
+            self.recording = True
+            self.started = time.time()
+        reactor.callLater(warmup, record)
+
+        yield defer.DeferredList(
+            [self.worker(deadline)
+             for _ in range(self.options['concurrency'])])
+        elapsed = time.time() - self.started
+
+        total = Latencies()
+        results = {}
+        for name, latencies in self.latencies.items():
+            if latencies.values:
+                results[name] = latencies.summary(elapsed)
+                total.values.extend(latencies.values)
+                for status, count in latencies.statuses.items():
+                    total.statuses[status] = \
+                        total.statuses.get(status, 0) + count
+        results['all'] = total.summary(elapsed)
+        defer.returnValue(results)
+
+
+class Subscriber(protocol.Protocol):
+    """ An EventSource connection to the SSE server, recording how long the
+    messages, which are their publication time, took to come.
+    """
+    def connectionMade(self):
+        self.buffer = b''
+        self.transport.write(b'GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                             b'Accept: text/event-stream\r\n\r\n')
+
+    def dataReceived(self, data):
+        now = time.time()
+        if not self.factory.connected_clients.get(self):
+            self.factory.connected_clients[self] = True
+            self.factory.connected += 1
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if line.startswith(b'data:'):
+                try:
+                    sent = float(line[5:].strip())
+                except ValueError:
+                    continue
+                self.factory.received(now - sent)
+
+    def connectionLost(self, reason):
+        self.factory.connected_clients.pop(self, None)
+
+
+class SubscriberFactory(protocol.ClientFactory):
+    protocol = Subscriber
+
+    def __init__(self):
+        self.connected_clients = {}
+        self.connected = 0
+        self.latencies = Latencies()
+        self.recording = False
+
+    def received(self, latency):
+        if self.recording:
+            self.latencies.record(latency, 'delivered')
+
+
+class SseLoad(object):
+    """ Publishes messages to SSE subscribers. """
+    def __init__(self, options, port):
+        self.options = options
+        self.port = port
+        self.agent = Agent(reactor,
+                           pool=HTTPConnectionPool(reactor, persistent=True))
+        self.factory = SubscriberFactory()
+        self.publish_latencies = Latencies()
+
+    @defer.inlineCallbacks
+    def connect(self):
+        """ Opens the subscriber connections, a few at a time so the listen
+        backlog doesn't overflow, and waits for all of them to be bound.
+        """
+        count = self.options['subscribers']
+        for i in range(count):
+            reactor.connectTCP('127.0.0.1', self.port, self.factory)
+            if i % 50 == 49:
+                yield task.deferLater(reactor, 0.05, lambda: None)
+        deadline = time.time() + 30
+        while self.factory.connected < count and time.time() < deadline:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+
+    @defer.inlineCallbacks
+    def publish(self):
+        started = time.time()
+        body = urlencode({'channel': 'base', 'message': repr(started)})
+        try:
+            response = yield self.agent.request(
+                b'POST', ('http://127.0.0.1:%d/publish' % self.port).encode(),
+                Headers({b'Content-Type':
+                         [b'application/x-www-form-urlencoded']}),
+                body_producer(body.encode('ascii')))
+            yield readBody(response)
+            code = response.code
+        except Exception as e:
+            code = 'error: %s' % e.__class__.__name__
+        if self.factory.recording:
+            self.publish_latencies.record(time.time() - started, code)
+
+    @defer.inlineCallbacks
+    def run(self):
+        yield self.connect()
+        connected = self.factory.connected
+        warmup, duration = self.options['warmup'], self.options['duration']
+
+        # each tick publishes the messages of its share of a second.
+        ticks = min(self.options['rate'], 100)
+        per_tick = self.options['rate'] / float(ticks)
+        state = {'due': 0.0}
+
+        def tick():
+            state['due'] += per_tick
+            while state['due'] >= 1:
+                state['due'] -= 1
+                self.publish()
+        loop = task.LoopingCall(tick)
+        loop.start(1.0 / ticks)
+
+        yield task.deferLater(reactor, warmup, lambda: None)
+        self.factory.recording = True
+        started = time.time()
+        yield task.deferLater(reactor, duration, lambda: None)
+        loop.stop()
+        # leave the last messages some time to arrive.
+        yield task.deferLater(reactor, 1, lambda: None)
+        self.factory.recording = False
+        elapsed = time.time() - started
+
+        published = self.publish_latencies.summary(elapsed)
+        delivered = self.factory.latencies.summary(elapsed)
+        expected = published['count'] * connected
+        delivered['ratio'] = delivered['count'] / float(expected) \
+            if expected else None
+        defer.returnValue({'subscribers': connected,
+                           'publish': published,
+                           'delivery': delivered})
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_results(results):
+    for target in ('rest', 'sse'):
+        if target not in results:
+            continue
+        print('== %s' % target)
+        rows = results[target].items() if target == 'rest' else \
+            [(name, results[target][name])
+             for name in ('publish', 'delivery')]
+        for name, row in sorted(rows):
+            print('%-12s %8d req %9.1f/s  p50 %7.2fms  p99 %7.2fms  '
+                  'p999 %7.2fms  %s' % (
+                      name, row['count'], row['throughput'],
+                      row.get('p50_ms', 0), row.get('p99_ms', 0),
+                      row.get('p999_ms', 0), row['statuses']))
+    for name, samples in results['rss_kb'].items():
+        values = [kb for _, kb in samples if kb is not None]
+        if values:
+            print('%s rss: %d kB -> %d kB (max %d kB)' % (
+                name, values[0], values[-1], max(values)))
+    print('client cpu: %.0f%%' % results['client_cpu_percent'])
+
+
+@defer.inlineCallbacks
+def run(options, ports, processes, results):
+    sampler = MemorySampler(processes, options['rss-interval'])
+    cpu = os.times()
+    started = time.time()
+    try:
+        loads = []
+        if 'rest' in processes:
+            loads.append(('rest', RestLoad(
+                options, 'http://127.0.0.1:%d' % ports['rest']).run()))
+        if 'sse' in processes:
+            loads.append(('sse', SseLoad(options, ports['sse']).run()))
+        for name, d in loads:
+            results[name] = yield d
+    except Exception:
+        results['error'] = traceback.format_exc()
+    finally:
+        results['rss_kb'] = sampler.stop()
+        times = os.times()
+        results['client_cpu_percent'] = 100 * (
+            times[0] + times[1] - cpu[0] - cpu[1]) / (time.time() - started)
+        reactor.stop()
+
+
+def main():
+    options = Options()
+    options.parseOptions()
+
+    log_dir = RESULTS_DIR
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    ports, processes = {}, {}
+    try:
+        if options['target'] in ('rest', 'both'):
+            ports['rest'] = free_port()
+            processes['rest'] = start_server(
+                [options['python'], 'run.py', '--data=memory',
+                 '-p', str(ports['rest'])] + options['rest-args'].split(),
+                REST_DIR, ports['rest'], os.path.join(log_dir, 'rest.log'))
+        if options['target'] in ('sse', 'both'):
+            ports['sse'] = free_port()
+            processes['sse'] = start_server(
+                [options['python'], '-c',
+                 'from twisted.scripts.twistd import run; run()',
+                 '-n', '--pidfile=', 'cyclone-sse', '-r', 'server.App',
+                 '--broker=http', '-p', str(ports['sse'])],
+                SSE_DIR, ports['sse'], os.path.join(log_dir, 'sse.log'))
+
+        results = {'commit': git_commit(),
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': sys.version.split()[0],
+                   'options': dict((key, options[key]) for key in
+                                   sorted(options) if key != 'output')}
+        reactor.callWhenRunning(run, options, ports, processes, results)
+        reactor.run()
+    finally:
+        for process in processes.values():
+            stop_server(process)
+
+    if 'error' in results:
+        sys.exit(results['error'])
+    print_results(results)
+    output = options['output'] or os.path.join(
+        RESULTS_DIR, '%s-%s.json' % (results['commit'],
+                                     time.strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results saved to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
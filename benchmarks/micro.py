@@ -0,0 +1,83 @@
+""" Microbenchmarks of the REST server hot path: `render_json`,
+`item_etag`, `fast_etag`, `transcode_document`, `parse_request`, the
+body compression and the date helpers, on the values of a typical
+collection page.
+
+    python benchmarks/micro.py [--output=results.json]
+"""
+import json
+import os
+import sys
+
+from cyclone.httpserver import HTTPRequest
+from cyclone.httputil import HTTPHeaders
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'cyclone-rest-server'))
+
+from render import render_json, renderer  # noqa: E402
+from utils import config, date_to_str, fast_etag, item_etag  # noqa: E402
+from utils import bson_encode, parse_request, set_defaults  # noqa: E402
+from utils import str_to_date  # noqa: E402
+from transcode import transcode_document  # noqa: E402
+from compression import CompressedBodies, compress  # noqa: E402
+
+from bench_render import bench, sample_page  # noqa: E402
+
+
+def sample_request():
+    return HTTPRequest(
+        'GET', '/jobs?where={"status":"queued"}&sort=-updated,user'
+        '&max_results=25&page=3&projection={"user":1}',
+        headers=HTTPHeaders({'If-Modified-Since':
+                             'Wed, 01 May 2013 12:30:15 GMT',
+                             'If-None-Match': '"abc"'}))
+
+
+def main(args):
+    output = None
+    for arg in args:
+        if arg.startswith('--output='):
+            output = arg.split('=', 1)[1]
+
+    page = sample_page(25)
+    items = page['items']
+    settings = set_defaults('/jobs')
+    request = sample_request()
+    dates = [item['updated'] for item in items]
+    headers = [date_to_str(date) for date in dates]
+    raw = bson_encode(dict(items[0], _etag=fast_etag(items[0])))
+    body = render_json(page)
+    bodies = CompressedBodies(config.COMPRESSION_CACHE_SIZE)
+
+    cases = [
+        ('render_json (25 items)', lambda: render_json(page), 2000),
+        ('item_etag', lambda: item_etag(items[0]), 20000),
+        ('fast_etag', lambda: fast_etag(items[0]), 20000),
+        ('transcode_document', lambda: transcode_document(raw), 20000),
+        ('gzip (25 items)', lambda: compress(body, 'gzip'), 1000),
+        ('cached gzip (25 items)',
+         lambda: bodies.get('etag', body, 'gzip'), 20000),
+        ('parse_request', lambda: parse_request(request, settings), 20000),
+        ('date_to_str (25 dates)',
+         lambda: [date_to_str(date) for date in dates], 5000),
+        ('str_to_date (25 dates)',
+         lambda: [str_to_date(header) for header in headers], 5000),
+    ]
+
+    results = {'python': sys.version.split()[0],
+               'json_engine': renderer.name,
+               'date_format': config.DATE_FORMAT,
+               'us_per_call': {}}
+    for label, func, number in cases:
+        t = bench(func, number)
+        results['us_per_call'][label] = t
+        print('%-24s %10.2f us' % (label, t))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
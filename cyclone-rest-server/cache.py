@@ -0,0 +1,143 @@
+""" Caches. The reactor runs handlers one at a time, so none of the
+in-process ones need any locking.
+"""
+from collections import OrderedDict
+import hashlib
+import time
+
+from bson import json_util
+from twisted.internet import defer
+
+
+class LRUCache(object):
+    """ A mapping holding at most `size` entries, evicting the least recently
+    used one first.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+def response_key(query):
+    """ Returns the key of a collection response in the response caches: the
+    canonical JSON of the query it comes from. Requests only differing in
+    the order of their arguments, or of the keys of their documents, share
+    it.
+
+    :param query: an instance of :class:`query.Query`.
+    """
+    return json_util.dumps([query.spec, query.sort, query.projection,
+                            query.skip, query.limit], sort_keys=True,
+                           separators=(',', ':'))
+
+
+class ResponseCache(object):
+    """ An in-process cache of rendered collection responses, holding at
+    most `size` of them for a limited time each.
+
+    Entries are stored under the generation of their resource, which
+    writes increment: the entries of a resource are invalidated at once,
+    and left to be evicted. Handlers read the generation before querying
+    the data layer, so a response raced by a write is stored under the
+    previous generation and never served.
+
+    Every method fires a Deferred, like :class:`RedisResponseCache` does.
+
+    :param size: the maximum number of responses.
+    """
+    def __init__(self, size):
+        self._entries = LRUCache(size)
+        self._generations = {}
+
+    def generation(self, resource):
+        return defer.succeed(self._generations.get(resource, 0))
+
+    def get(self, resource, generation, key):
+        """ Fires with the `(body, etag)` of a response, or `None`. """
+        entry = self._entries.get((resource, generation, key))
+        if entry is None:
+            return defer.succeed(None)
+        expires, body, etag = entry
+        if expires < time.time():
+            self._entries.pop((resource, generation, key))
+            return defer.succeed(None)
+        return defer.succeed((body, etag))
+
+    def set(self, resource, generation, key, body, etag, ttl):
+        self._entries.set((resource, generation, key),
+                          (time.time() + ttl, body, etag))
+        return defer.succeed(None)
+
+    def invalidate(self, resource):
+        self._generations[resource] = self._generations.get(resource, 0) + 1
+        return defer.succeed(None)
+
+
+class RedisResponseCache(object):
+    """ A response cache kept in Redis, shared by the worker processes and
+    the servers using the same Redis. Redis evicts the expired responses.
+
+    :param redis: a :mod:`cyclone.redis` connection or pool.
+    :param prefix: the prefix of the Redis keys.
+    """
+    def __init__(self, redis, prefix='rest:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def _generation_key(self, resource):
+        return '%sgeneration:%s' % (self.prefix, resource)
+
+    def _entry_key(self, resource, generation, key):
+        return '%sresponse:%s:%s:%s' % (
+            self.prefix, resource, generation,
+            hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def generation(self, resource):
+        d = self.redis.get(self._generation_key(resource))
+        d.addCallback(lambda generation: int(generation or 0))
+        return d
+
+    def get(self, resource, generation, key):
+        def decode(value):
+            if value is None:
+                return None
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            etag, body = value.split(b'\n', 1)
+            return body, etag.decode('ascii')
+        d = self.redis.get(self._entry_key(resource, generation, key))
+        d.addCallback(decode)
+        return d
+
+    def set(self, resource, generation, key, body, etag, ttl):
+        return self.redis.setex(self._entry_key(resource, generation, key),
+                                int(ttl), etag.encode('ascii') + b'\n' + body)
+
+    def invalidate(self, resource):
+        return self.redis.incr(self._generation_key(resource))
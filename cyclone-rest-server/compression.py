@@ -0,0 +1,105 @@
+""" Compression of the response bodies.
+
+Bodies are compressed with the encoding the client prefers among gzip and
+brotli, when the brotli module is installed. A response is identified by
+its ETag, so the compressed bodies are kept by ETag: a page requested over
+and over again is compressed once.
+"""
+from collections import OrderedDict
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from utils import config
+
+# by order of preference, when the client has none.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# Accept-Encoding headers only come in a few flavours.
+_negotiated = {}
+_NEGOTIATED_SIZE = 1000
+
+
+def negotiate(accept_encoding):
+    """ Returns the encoding to send a body with, `None` for none.
+
+    :param accept_encoding: the Accept-Encoding request header.
+    """
+    if not accept_encoding:
+        return None
+    encoding = _negotiated.get(accept_encoding, False)
+    if encoding is not False:
+        return encoding
+
+    weights = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    default = weights.get('*', 0.0)
+    encoding = None
+    best = 0.0
+    for name in ENCODINGS:
+        weight = weights.get(name, default)
+        if weight > best:
+            encoding, best = name, weight
+
+    if len(_negotiated) < _NEGOTIATED_SIZE:
+        _negotiated[accept_encoding] = encoding
+    return encoding
+
+
+def compress(body, encoding):
+    """ Returns `body` compressed with `encoding`, 'gzip' or 'br'. """
+    if encoding == 'br':
+        return brotli.compress(body, quality=config.BROTLI_QUALITY)
+    # with a gzip header and trailer.
+    compressor = zlib.compressobj(config.GZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+class CompressedBodies(object):
+    """ The compressed response bodies, by key and encoding, holding at most
+    `size` bytes of them. The least recently used ones are evicted first.
+
+    :param size: the maximum number of bytes held.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self._bodies = OrderedDict()
+
+    def get(self, key, body, encoding):
+        """ Returns `body` compressed with `encoding`, as it was compressed
+        the first time when it was under the same key.
+
+        :param key: identifies the body, e.g. its resource and ETag.
+        :param body: the uncompressed body.
+        :param encoding: 'gzip' or 'br'.
+        """
+        key = (key, encoding)
+        compressed = self._bodies.pop(key, None)
+        if compressed is not None:
+            self.hits += 1
+            self._bodies[key] = compressed
+            return compressed
+
+        self.misses += 1
+        compressed = compress(body, encoding)
+        if len(compressed) <= self.size:
+            self._bodies[key] = compressed
+            self.bytes += len(compressed)
+            while self.bytes > self.size:
+                self.bytes -= len(self._bodies.popitem(last=False)[1])
+        return compressed
@@ -0,0 +1,491 @@
+""" Data access layer for the cyclone REST server.
+
+Every method returns a :class:`~twisted.internet.defer.Deferred`, so that
+no request ever blocks the reactor thread while waiting on the database.
+"""
+import copy
+from collections import OrderedDict
+
+from bson.objectid import ObjectId
+from twisted.internet import defer
+
+from utils import bson_encode, config
+
+# the oldest txmongo release with the API the mongo data layer relies on:
+# the pymongo 3 style methods, `with_options` and `find_with_cursor`.
+TXMONGO_VERSION = '19.2'
+
+try:
+    from txmongo import filter as qf
+    from txmongo.collection import Collection
+    from txmongo.connection import ConnectionPool
+except ImportError:
+    ConnectionPool = None
+
+try:
+    from bson.codec_options import CodecOptions
+    from bson.raw_bson import RawBSONDocument
+    _raw_options = CodecOptions(document_class=RawBSONDocument)
+except ImportError:
+    _raw_options = None
+
+
+class DataLayerError(Exception):
+    pass
+
+
+class DataLayer(object):
+    """ Base data layer class. Defines the interface that actual data-access
+    classes, being subclasses, must implement.
+
+    `resource` is always the datasource name of the resource as found in
+    ``settings['datasource']['source']``.
+    """
+    def __init__(self, settings=None):
+        self.settings = settings or {}
+        self.init(self.settings)
+
+    def init(self, settings):
+        """ Sets up the connection to the backend. """
+        pass
+
+    def find(self, resource, query):
+        """ Retrieves the documents matching a query, already filtered,
+        sorted, projected and paginated by the backend. Fires with a list of
+        documents.
+
+        :param resource: the datasource name.
+        :param query: an instance of :class:`query.Query`.
+        """
+        raise NotImplementedError
+
+    def find_raw(self, resource, query):
+        """ Same as :meth:`find`, but fires with the BSON encoding of the
+        documents, as bytes, for the callers which only transcode them.
+        Backends speaking BSON hand over the bytes they received.
+
+        :param resource: the datasource name.
+        :param query: an instance of :class:`query.Query`.
+        """
+        d = self.find(resource, query)
+        d.addCallback(lambda documents: [bson_encode(document)
+                                         for document in documents])
+        return d
+
+    def cursor(self, resource, query, batch_size, raw=False):
+        """ Retrieves the documents matching a query in batches. Returns a
+        cursor whose `next_batch()` fires with the next list of documents,
+        `exhausted` tells whether there is any left and `close()` releases
+        it early.
+
+        :param resource: the datasource name.
+        :param query: an instance of :class:`query.Query`.
+        :param batch_size: the number of documents per batch.
+        :param raw: whether the documents come as their BSON encoding, like
+                    with :meth:`find_raw`.
+        """
+        raise NotImplementedError
+
+    def count(self, resource, query):
+        """ Counts all the documents matching the query filter, regardless
+        of pagination. Fires with the count.
+
+        :param resource: the datasource name.
+        :param query: an instance of :class:`query.Query`.
+        """
+        raise NotImplementedError
+
+    def find_one(self, resource, **lookup):
+        """ Retrieves a single document. Fires with the document or `None`.
+
+        :param resource: the datasource name.
+        :param lookup: the lookup fields.
+        """
+        raise NotImplementedError
+
+    def find_one_raw(self, resource, **lookup):
+        """ Same as :meth:`find_one`, but fires with the BSON encoding of
+        the document, as bytes, or `None`.
+
+        :param resource: the datasource name.
+        :param lookup: the lookup fields.
+        """
+        d = self.find_one(resource, **lookup)
+        d.addCallback(lambda document: None if document is None
+                      else bson_encode(document))
+        return d
+
+    def insert(self, resource, documents):
+        """ Inserts a list of documents. Fires with the list of their ids.
+
+        :param resource: the datasource name.
+        :param documents: the documents to be inserted.
+        """
+        raise NotImplementedError
+
+    def replace(self, resource, id_, document):
+        """ Replaces a document. Fires with `True` if it existed.
+
+        :param resource: the datasource name.
+        :param id_: the unique id of the document.
+        :param document: the new document.
+        """
+        raise NotImplementedError
+
+    def remove(self, resource, id_):
+        """ Removes a document. Fires with `True` if it existed.
+
+        :param resource: the datasource name.
+        :param id_: the unique id of the document.
+        """
+        raise NotImplementedError
+
+    def indexes(self, resource):
+        """ Fires with the indexes of a datasource, as lists of (field,
+        direction) tuples.
+
+        :param resource: the datasource name.
+        """
+        raise NotImplementedError
+
+    def create_index(self, resource, index):
+        """ Creates an index, fires once it exists.
+
+        :param resource: the datasource name.
+        :param index: the list of (field, direction) tuples of the index.
+        """
+        raise NotImplementedError
+
+    def _collection_name(self, resource):
+        return resource.strip('/')
+
+    def _object_id(self, id_):
+        """ Ids coming from the url are strings. Documents created through
+        the API however have ObjectId ids, so try to convert them first.
+        """
+        if isinstance(id_, ObjectId) or not ObjectId.is_valid(id_):
+            return id_
+        return ObjectId(id_)
+
+    def _lookup(self, lookup):
+        if config.ID_FIELD in lookup:
+            lookup = dict(lookup)
+            lookup[config.ID_FIELD] = self._object_id(lookup[config.ID_FIELD])
+        return lookup
+
+
+class MemoryDataLayer(DataLayer):
+    """ In-memory stand-in for :class:`MongoDataLayer`, to be used by tests
+    and local runs without a database. Documents are copied in and out so
+    that callers can't mutate the stored state, just like with a real
+    database.
+    """
+    def init(self, settings):
+        self._collections = {}
+        # only recorded, queries scan the documents anyway.
+        self._indexes = {}
+
+    def _collection(self, resource):
+        name = self._collection_name(resource)
+        return self._collections.setdefault(name, OrderedDict())
+
+    def _find(self, resource, query):
+        documents = [d for d in self._collection(resource).values()
+                     if _match(d, query.spec)]
+        for field, direction in reversed(query.sort):
+            documents.sort(key=lambda d: _sort_key(d.get(field)),
+                           reverse=direction < 0)
+        if query.limit:
+            return documents[query.skip:query.skip + query.limit]
+        return documents[query.skip:]
+
+    def find(self, resource, query):
+        return defer.succeed([_project(d, query.projection)
+                              for d in self._find(resource, query)])
+
+    def cursor(self, resource, query, batch_size, raw=False):
+        return _MemoryCursor(self._find(resource, query), query.projection,
+                             batch_size, raw)
+
+    def count(self, resource, query):
+        documents = self._collection(resource).values()
+        return defer.succeed(len([d for d in documents
+                                  if _match(d, query.spec)]))
+
+    def find_one(self, resource, **lookup):
+        lookup = self._lookup(lookup)
+        for document in self._collection(resource).values():
+            if all(document.get(k) == v for k, v in lookup.items()):
+                return defer.succeed(copy.deepcopy(document))
+        return defer.succeed(None)
+
+    def insert(self, resource, documents):
+        collection = self._collection(resource)
+        ids = []
+        for document in documents:
+            document.setdefault(config.ID_FIELD, ObjectId())
+            id_ = document[config.ID_FIELD]
+            if id_ in collection:
+                return defer.fail(DataLayerError('duplicate id %s' % id_))
+            collection[id_] = copy.deepcopy(document)
+            ids.append(id_)
+        return defer.succeed(ids)
+
+    def replace(self, resource, id_, document):
+        collection = self._collection(resource)
+        id_ = self._object_id(id_)
+        if id_ not in collection:
+            return defer.succeed(False)
+        document = copy.deepcopy(document)
+        document[config.ID_FIELD] = id_
+        collection[id_] = document
+        return defer.succeed(True)
+
+    def remove(self, resource, id_):
+        collection = self._collection(resource)
+        return defer.succeed(
+            collection.pop(self._object_id(id_), None) is not None)
+
+    def indexes(self, resource):
+        name = self._collection_name(resource)
+        return defer.succeed(list(self._indexes.get(
+            name, [[(config.ID_FIELD, 1)]])))
+
+    def create_index(self, resource, index):
+        name = self._collection_name(resource)
+        indexes = self._indexes.setdefault(name, [[(config.ID_FIELD, 1)]])
+        if index not in indexes:
+            indexes.append(list(index))
+        return defer.succeed(None)
+
+
+class _MemoryCursor(object):
+    """ The cursor of the in-memory data layer. """
+    def __init__(self, documents, projection, batch_size, raw):
+        self._documents = documents
+        self._projection = projection
+        self._batch_size = batch_size
+        self._raw = raw
+
+    @property
+    def exhausted(self):
+        return not self._documents
+
+    def next_batch(self):
+        batch = self._documents[:self._batch_size]
+        del self._documents[:self._batch_size]
+        batch = [_project(d, self._projection) for d in batch]
+        if self._raw:
+            batch = [bson_encode(d) for d in batch]
+        return defer.succeed(batch)
+
+    def close(self):
+        self._documents = []
+        return defer.succeed(None)
+
+
+class _MongoCursor(object):
+    """ The cursor of the mongo data layer, over the batches of
+    `find_with_cursor`: it fires with the first (documents, deferred) pair,
+    and every deferred with the next pair, ``([], None)`` being the last.
+
+    :param deferred: the Deferred returned by `find_with_cursor`.
+    :param encode: turns the documents of a batch into what the cursor
+                   fires with, if anything.
+    """
+    def __init__(self, deferred, encode=None):
+        self._next = deferred
+        self._encode = encode
+        self.exhausted = False
+
+    def next_batch(self):
+        d, self._next = self._next, None
+        return d.addCallback(self._batch)
+
+    def _batch(self, result):
+        documents, self._next = result
+        self.exhausted = self._next is None
+        if self._encode is not None:
+            documents = [self._encode(document) for document in documents]
+        return documents
+
+    def close(self):
+        # cancelling the pending batch kills the server cursor.
+        self.exhausted = True
+        d, self._next = self._next, None
+        if d is not None:
+            d.addErrback(lambda failure: failure.trap(defer.CancelledError))
+            d.cancel()
+        return defer.succeed(None)
+
+
+class MongoDataLayer(DataLayer):
+    """ MongoDB data access layer built on txmongo, TXMONGO_VERSION or
+    later. All the requests share a pool of non-blocking connections.
+    """
+    def init(self, settings):
+        if ConnectionPool is None:
+            raise DataLayerError('txmongo is required by the mongo data layer')
+        if not hasattr(Collection, 'find_with_cursor'):
+            raise DataLayerError('the mongo data layer requires txmongo %s '
+                                 'or later' % TXMONGO_VERSION)
+        self.pool = ConnectionPool(settings.get('mongo-uri', config.MONGO_URI),
+                                   pool_size=settings.get(
+                                       'mongo-pool-size',
+                                       config.MONGO_POOL_SIZE))
+        self.db = self.pool[settings.get('mongo-dbname', config.MONGO_DBNAME)]
+
+    def _collection(self, resource):
+        return self.db[self._collection_name(resource)]
+
+    def find(self, resource, query):
+        sort = qf.sort(query.sort) if query.sort else None
+        return self._collection(resource).find(
+            filter=query.spec, projection=query.projection, skip=query.skip,
+            limit=query.limit, sort=sort)
+
+    def find_raw(self, resource, query):
+        if _raw_options is None:
+            return DataLayer.find_raw(self, resource, query)
+        # the documents are not decoded at all.
+        sort = qf.sort(query.sort) if query.sort else None
+        d = self._collection(resource).with_options(
+            codec_options=_raw_options).find(
+                filter=query.spec, projection=query.projection,
+                skip=query.skip, limit=query.limit, sort=sort)
+        d.addCallback(lambda documents: [document.raw
+                                         for document in documents])
+        return d
+
+    def cursor(self, resource, query, batch_size, raw=False):
+        # find() fires with every document at once.
+        sort = qf.sort(query.sort) if query.sort else None
+        collection, encode = self._collection(resource), None
+        if raw and _raw_options is None:
+            encode = bson_encode
+        elif raw:
+            collection = collection.with_options(codec_options=_raw_options)
+            encode = _raw_bytes
+        return _MongoCursor(collection.find_with_cursor(
+            filter=query.spec, projection=query.projection, skip=query.skip,
+            limit=query.limit, sort=sort, batch_size=batch_size), encode)
+
+    def count(self, resource, query):
+        return self._collection(resource).count(query.spec)
+
+    def find_one(self, resource, **lookup):
+        return self._collection(resource).find_one(self._lookup(lookup))
+
+    def find_one_raw(self, resource, **lookup):
+        if _raw_options is None:
+            return DataLayer.find_one_raw(self, resource, **lookup)
+        d = self._collection(resource).with_options(
+            codec_options=_raw_options).find_one(self._lookup(lookup))
+        d.addCallback(lambda document: None if document is None
+                      else document.raw)
+        return d
+
+    def insert(self, resource, documents):
+        d = self._collection(resource).insert_many(documents)
+        d.addCallback(lambda result: result.inserted_ids)
+        return d
+
+    def replace(self, resource, id_, document):
+        d = self._collection(resource).replace_one(
+            {config.ID_FIELD: self._object_id(id_)}, document)
+        d.addCallback(lambda result: result.matched_count > 0)
+        return d
+
+    def remove(self, resource, id_):
+        d = self._collection(resource).delete_one(
+            {config.ID_FIELD: self._object_id(id_)})
+        d.addCallback(lambda result: result.deleted_count > 0)
+        return d
+
+    def indexes(self, resource):
+        d = self._collection(resource).index_information()
+        d.addCallback(lambda information: [
+            _index_key(index['key']) for index in information.values()])
+        return d
+
+    def create_index(self, resource, index):
+        return self._collection(resource).create_index(qf.sort(index))
+
+
+_operators = {
+    '$eq': lambda value, arg: value == arg,
+    '$ne': lambda value, arg: value != arg,
+    '$gt': lambda value, arg: value is not None and value > arg,
+    '$gte': lambda value, arg: value is not None and value >= arg,
+    '$lt': lambda value, arg: value is not None and value < arg,
+    '$lte': lambda value, arg: value is not None and value <= arg,
+    '$in': lambda value, arg: value in arg,
+    '$nin': lambda value, arg: value not in arg,
+}
+
+
+def _match(document, spec):
+    """ Evaluates the subset of the MongoDB query language the API relies
+    on against a document.
+    """
+    for key, condition in spec.items():
+        if key == '$and':
+            if not all(_match(document, s) for s in condition):
+                return False
+        elif key == '$or':
+            if not any(_match(document, s) for s in condition):
+                return False
+        elif key == '$nor':
+            if any(_match(document, s) for s in condition):
+                return False
+        elif isinstance(condition, dict) and condition and \
+                all(op.startswith('$') for op in condition):
+            value = document.get(key)
+            for op, arg in condition.items():
+                if op == '$exists':
+                    if (key in document) != bool(arg):
+                        return False
+                elif op not in _operators:
+                    raise DataLayerError('unsupported operator %s' % op)
+                else:
+                    try:
+                        if not _operators[op](value, arg):
+                            return False
+                    except TypeError:
+                        return False
+        elif document.get(key) != condition:
+            return False
+    return True
+
+
+def _raw_bytes(document):
+    return document.raw
+
+
+def _index_key(key):
+    """ Returns the (field, direction) list of a MongoDB index key, the
+    direction of special indexes (text, 2dsphere, ...) as it is.
+    """
+    if hasattr(key, 'items'):
+        key = key.items()
+    return [(field, int(direction))
+            if isinstance(direction, (int, float)) else (field, direction)
+            for field, direction in key]
+
+
+def _sort_key(value):
+    # missing and null values sort first, like MongoDB does.
+    return (0, None) if value is None else (1, value)
+
+
+def _project(document, projection):
+    if projection is None:
+        return copy.deepcopy(document)
+    if any(projection.values()):
+        fields = [k for k, v in projection.items() if v]
+        if projection.get(config.ID_FIELD, 1):
+            fields.append(config.ID_FIELD)
+        return dict((k, copy.deepcopy(document[k]))
+                    for k in fields if k in document)
+    return dict((k, copy.deepcopy(v)) for k, v in document.items()
+                if projection.get(k, 1))
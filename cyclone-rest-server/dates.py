@@ -0,0 +1,78 @@
+""" RFC 1123 date codec.
+
+``datetime.strftime`` and ``datetime.strptime`` are slow (strptime goes
+through a regular expression built from the current locale) and their day
+and month names depend on the locale too. HTTP dates always use the English
+names, so they are formatted and parsed by hand here, and the results of
+both are memoized: the same `updated`/`created` values and the same
+If-Modified-Since headers come up over and over.
+"""
+from datetime import datetime
+
+from cache import LRUCache
+
+RFC1123_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
+
+_days = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_months = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug',
+           'Sep', 'Oct', 'Nov', 'Dec')
+_month_numbers = dict((name, i) for i, name in enumerate(_months) if name)
+
+# formatted dates, keyed by the datetime values themselves: stripping the
+# microseconds to share entries within a second costs more than formatting.
+# Cleared when full, which is cheaper than keeping it in LRU order.
+_formatted = {}
+FORMAT_CACHE_SIZE = 8192
+
+# parsed header values.
+_parsed = LRUCache(256)
+
+
+def format_date(date):
+    """ Returns the RFC 1123 string of a datetime value. Naive values are
+    assumed to be in UTC.
+
+    :param date: the datetime value to format.
+    """
+    if date.tzinfo is not None:
+        date = (date - date.utcoffset()).replace(tzinfo=None)
+    try:
+        return _formatted[date]
+    except KeyError:
+        pass
+    string = '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        _days[date.weekday()], date.day, _months[date.month], date.year,
+        date.hour, date.minute, date.second)
+    if len(_formatted) >= FORMAT_CACHE_SIZE:
+        _formatted.clear()
+    _formatted[date] = string
+    return string
+
+
+def parse_date(string):
+    """ Returns the datetime value of a RFC 1123 string such as
+    ``Sun, 06 Nov 1994 08:49:37 GMT``. Raises `ValueError` if the string
+    isn't one.
+
+    :param string: the RFC 1123 string to parse.
+    """
+    date = _parsed.get(string)
+    if date is None:
+        date = _parse(string)
+        _parsed.set(string, date)
+    return date
+
+
+def _parse(string):
+    if len(string) != 29 or string[3:5] != ', ' or \
+            string[25:] != ' GMT' or string[:3] not in _days or \
+            string[7] != ' ' or string[11] != ' ' or string[16] != ' ' or \
+            string[19] != ':' or string[22] != ':':
+        raise ValueError('%r is not a RFC 1123 date' % string)
+    try:
+        month = _month_numbers[string[8:11]]
+    except KeyError:
+        raise ValueError('%r is not a RFC 1123 date' % string)
+    return datetime(int(string[12:16]), month, int(string[5:7]),
+                    int(string[17:19]), int(string[20:22]),
+                    int(string[23:25]))
@@ -0,0 +1,177 @@
+""" Change events of the writes, published to the SSE server so that clients
+get pushed the changes instead of polling the collections.
+
+A write publishes an event on the ``<resource>.<id>`` channel, e.g.
+``jobs.5204e3d7a5d5b3c4e8f0a1b2``, which the SSE clients subscribed to the
+``jobs.*`` pattern get too::
+
+    {"resource": "jobs", "op": "replace", "_id": "...", "updated": "...",
+     "etag": "..."}
+
+`op` is one of 'insert', 'replace' and 'delete', and with EVENTS_DELTA the
+event holds the fields the write changed, in `delta`.
+
+Events are queued and sent in batches after the responses went out, so
+publishing never delays a write. They are dropped when the broker is
+unreachable: clients catch up with their conditional GETs.
+"""
+from collections import deque
+import json
+
+from cyclone import httpclient
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from render import render_json
+from utils import config, urlencode
+
+
+def channel_prefix(resource):
+    """ Returns the channel prefix of a resource, e.g. 'jobs' for '/jobs'. """
+    return resource.strip('/').replace('/', '.')
+
+
+def delta(original, document):
+    """ Returns the fields of `document` which differ from the ones of
+    `original`, the removed ones set to `None`.
+    """
+    # the id and the update date are in every event.
+    skipped = (config.ID_FIELD, config.ETAG_FIELD, 'updated')
+    changes = dict((field, value) for field, value in document.items()
+                   if field not in skipped and
+                   original.get(field) != value)
+    changes.update((field, None) for field in original
+                   if field not in skipped and field not in document)
+    return changes
+
+
+class ChangePublisher(object):
+    """ Queues the change events and sends them in batches, at most every
+    `interval` seconds and one batch at a time, so the events of an item
+    reach the broker in order.
+
+    :param interval: the number of seconds the events are collected for.
+    :param queue_size: the number of events queued, the oldest ones are
+                       dropped beyond.
+    """
+    def __init__(self, interval=None, queue_size=None):
+        self.interval = config.EVENTS_INTERVAL if interval is None \
+            else interval
+        self.pending = deque()
+        self.queue_size = config.EVENTS_QUEUE_SIZE if queue_size is None \
+            else queue_size
+        self.published = self.dropped = self.failed = 0
+        self._call = None
+        self._sending = None
+
+    def publish(self, resource, op, status, changes=None):
+        """ Queues the event of a write.
+
+        :param resource: the name of the resource.
+        :param op: 'insert', 'replace' or 'delete'.
+        :param status: the id of the item, its `updated` and `etag`.
+        :param changes: the fields the write changed.
+        """
+        prefix = channel_prefix(resource)
+        event = {'resource': prefix, 'op': op}
+        for field in (config.ID_FIELD, 'updated', 'etag'):
+            if field in status:
+                event[field] = status[field]
+        if changes is not None:
+            event['delta'] = changes
+        if len(self.pending) >= self.queue_size:
+            self.pending.popleft()
+            self.dropped += 1
+        self.pending.append(('%s.%s' % (prefix, status[config.ID_FIELD]),
+                             render_json(event, False)))
+        self._schedule()
+
+    def _schedule(self):
+        if self._call is None and self._sending is None:
+            self._call = reactor.callLater(self.interval, self.flush)
+
+    def flush(self):
+        """ Sends the queued events. Fires once they are sent, after the
+        batch being sent if there is one, e.g. before shutting down.
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if self._sending is not None:
+            # one batch at a time, the events queued since go next.
+            d = defer.Deferred()
+            self._sending.addBoth(self._flush_next, d)
+            return d
+        if not self.pending:
+            return defer.succeed(None)
+        batch = list(self.pending)
+        self.pending.clear()
+        self._sending = d = defer.maybeDeferred(self.send, batch)
+        d.addCallbacks(self._sent, self._failed, callbackArgs=(len(batch),),
+                       errbackArgs=(len(batch),))
+        return d
+
+    def send(self, batch):
+        """ Sends a batch of events, a list of (channel, JSON message)
+        pairs. Returns a Deferred.
+        """
+        raise NotImplementedError
+
+    def _flush_next(self, _, d):
+        self.flush().chainDeferred(d)
+
+    def _sent(self, _, count):
+        self.published += count
+        self._done()
+
+    def _failed(self, failure, count):
+        self.failed += count
+        log.msg('could not publish %d change events: %s' % (
+            count, failure.getErrorMessage()))
+        self._done()
+
+    def _done(self):
+        self._sending = None
+        if self.pending:
+            self._schedule()
+
+
+class RedisPublisher(ChangePublisher):
+    """ Publishes the events to Redis, for the SSE servers using the Redis
+    broker. The commands of a batch are pipelined on a single connection.
+
+    :param redis: a :mod:`cyclone.redis` connection.
+    """
+    def __init__(self, redis, **kwargs):
+        ChangePublisher.__init__(self, **kwargs)
+        self.redis = redis
+
+    def send(self, batch):
+        return defer.gatherResults([self.redis.publish(channel, message)
+                                    for channel, message in batch],
+                                   consumeErrors=True)
+
+
+class HttpPublisher(ChangePublisher):
+    """ Posts the events to the batch publish endpoint of an SSE server
+    using the HTTP broker, a single request per batch.
+
+    :param url: the url of the endpoint.
+    :param secret: the `http-secret` of the SSE server.
+    """
+    def __init__(self, url, secret='', **kwargs):
+        ChangePublisher.__init__(self, **kwargs)
+        self.url = url
+        if secret:
+            self.url += ('&' if '?' in url else '?') + \
+                urlencode({'key': secret})
+
+    @defer.inlineCallbacks
+    def send(self, batch):
+        body = json.dumps([[channel, message.decode('utf-8')]
+                           for channel, message in batch])
+        response = yield httpclient.fetch(
+            self.url, method='POST', postdata=body,
+            headers={'Content-Type': ['application/json']})
+        if response.code != 200:
+            raise IOError('%s returned %s' % (self.url, response.code))
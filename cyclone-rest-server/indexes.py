@@ -0,0 +1,230 @@
+""" Indexes of the resource collections.
+
+At startup the indexes the resource settings call for are created when
+missing: one per filterable field, the `updated` and `created` ones the
+feeds sort on, with the id tie-breaker of cursor pagination, and the ones
+listed in the `indexes` setting of the resource.
+
+At runtime, the `where` and `sort` shapes of the collection queries which
+no index serves are counted and timed, and regularly logged: they are the
+queries scanning the collection or sorting in memory.
+"""
+from twisted.internet import defer, task
+from twisted.python import log
+
+from utils import config
+
+# the fields of the automatic sorts.
+DATE_FIELDS = ('updated', 'created')
+
+# query shapes tracked at once, `where` allowing any field.
+_SHAPES_SIZE = 10000
+
+
+def required_indexes(settings):
+    """ Returns the indexes a resource needs, as lists of (field, direction)
+    tuples.
+
+    :param settings: the resource settings.
+    """
+    indexes = []
+    cursor = settings['pagination_mode'] == 'cursor'
+    filters = settings['allowed_filters']
+    if filters and '*' not in filters:
+        # with cursor pagination, the results come sorted by id at least.
+        indexes.extend([(field, 1), (config.ID_FIELD, 1)] if cursor
+                       else [(field, 1)] for field in filters
+                       if field != config.ID_FIELD)
+    if cursor:
+        # the tie-breaker keeps its direction, whichever way the date goes.
+        for field in DATE_FIELDS:
+            indexes.append([(field, 1), (config.ID_FIELD, 1)])
+            indexes.append([(field, -1), (config.ID_FIELD, 1)])
+    else:
+        indexes.extend([(field, 1)] for field in DATE_FIELDS)
+    indexes.extend([tuple(key) for key in index]
+                   for index in settings['indexes'])
+
+    unique = []
+    for index in indexes:
+        if index not in unique:
+            unique.append(index)
+    return unique
+
+
+def query_shape(spec):
+    """ Returns the fields a filter compares for equality, and the ones it
+    compares otherwise, along with the top-level operators no index serves.
+    """
+    equality, ranges = set(), set()
+    for key, condition in spec.items():
+        if key == '$and' and isinstance(condition, list):
+            for clause in condition:
+                clause_equality, clause_ranges = query_shape(clause)
+                equality |= clause_equality
+                ranges |= clause_ranges
+        elif key in ('$or', '$nor') and isinstance(condition, list):
+            # $or and $nor clauses can't use a shared prefix.
+            for clause in condition:
+                for fields in query_shape(clause):
+                    ranges |= fields
+        elif key.startswith('$'):
+            # no index serves the other operators, the shape keeps them.
+            ranges.add(key)
+        elif isinstance(condition, dict) and condition and \
+                all(op.startswith('$') for op in condition):
+            if set(condition) == set(['$eq']):
+                equality.add(key)
+            else:
+                ranges.add(key)
+        else:
+            equality.add(key)
+    return equality, ranges - equality
+
+
+def serves(index, equality, ranges, sort):
+    """ Whether an index serves a query without a collection scan or an
+    in-memory sort: its fields have to start with the equality ones, in any
+    order, followed by the sort ones, all in the sort direction or all in
+    the opposite one. Without equality fields, the filter has to be a range
+    on the first sort field.
+
+    :param index: the (field, direction) list of the index.
+    :param equality: the fields compared for equality.
+    :param ranges: the fields compared otherwise.
+    :param sort: the (field, direction) list of the query sort.
+    """
+    # sorting on a field compared for equality is free.
+    sort = [(field, d) for field, d in sort if field not in equality]
+    position = 0
+    while position < len(index) and index[position][0] in equality:
+        position += 1
+    if sort:
+        part = index[position:position + len(sort)]
+        if [field for field, _ in part] != [field for field, _ in sort]:
+            return False
+        if position == 0 and (equality or ranges) and \
+                sort[0][0] not in ranges:
+            # walks the whole index, filtering every document.
+            return False
+        directions = [d * s for (_, d), (_, s) in zip(part, sort)]
+        return len(set(directions)) == 1
+    return position > 0 or (bool(index) and index[0][0] in ranges)
+
+
+class _Shape(object):
+    __slots__ = ('count', 'total', 'slowest')
+
+    def __init__(self):
+        self.count = 0
+        self.total = self.slowest = 0.0
+
+
+class IndexAdvisor(object):
+    """ Creates the missing indexes, and keeps track of the query shapes
+    they don't serve.
+
+    :param data: the data layer.
+    :param resources: the :class:`registry.ResourceRegistry`.
+    """
+    def __init__(self, data, resources):
+        self.data = data
+        self.resources = resources
+        # the indexes of every datasource.
+        self.indexes = {}
+        # (resource, where shape, sort) -> _Shape.
+        self.shapes = {}
+        self._served = {}
+
+    @defer.inlineCallbacks
+    def ensure_indexes(self, create=True):
+        """ Reads the indexes of the collections, and creates the missing
+        ones the resources need.
+
+        :param create: whether the missing indexes get created, or only
+                       logged.
+        """
+        for resource in self.resources:
+            source = resource.source
+            existing = yield self.data.indexes(source)
+            self.indexes[source] = existing
+            for index in required_indexes(resource.settings):
+                if index in existing:
+                    continue
+                if not create:
+                    log.msg('%s lacks the index %r' % (source, index))
+                    continue
+                try:
+                    yield self.data.create_index(source, index)
+                except Exception as e:
+                    log.msg('could not create the index %r of %s: %s' % (
+                        index, source, e))
+                else:
+                    log.msg('created the index %r of %s' % (index, source))
+                    existing.append(index)
+        self._served.clear()
+
+    def observe(self, resource, query, elapsed):
+        """ Records a collection query, if no index serves it. Never raises,
+        the query being done already.
+
+        :param resource: the :class:`registry.Resource`.
+        :param query: the :class:`query.Query`.
+        :param elapsed: the duration of the query, in seconds.
+        """
+        try:
+            self._observe(resource, query, elapsed)
+        except Exception:
+            log.err(None, 'could not observe a query on %s' % resource.name)
+
+    def _observe(self, resource, query, elapsed):
+        equality, ranges = query_shape(query.spec)
+        key = (resource.name, tuple(sorted(equality)),
+               tuple(sorted(ranges)), tuple(query.sort))
+        served = self._served.get(key)
+        if served is None:
+            if len(self._served) >= _SHAPES_SIZE:
+                self._served.clear()
+            if not equality and not ranges and not query.sort:
+                # a plain listing scans the collection anyway.
+                served = True
+            elif any(field.startswith('$') for field in ranges):
+                served = False
+            else:
+                served = any(serves(index, equality, ranges, query.sort)
+                             for index in self.indexes.get(resource.source,
+                                                           ()))
+            self._served[key] = served
+        if served:
+            return
+        shape = self.shapes.get(key)
+        if shape is None:
+            if len(self.shapes) >= _SHAPES_SIZE:
+                return
+            shape = self.shapes[key] = _Shape()
+        shape.count += 1
+        shape.total += elapsed
+        shape.slowest = max(shape.slowest, elapsed)
+
+    def report(self, size=None):
+        """ Logs the query shapes no index serves, the most frequent first,
+        and starts counting again.
+        """
+        shapes, self.shapes = self.shapes, {}
+        ranked = sorted(shapes.items(), key=lambda item: -item[1].count)
+        for (name, equality, ranges, sort), shape in \
+                ranked[:size or config.INDEX_REPORT_SIZE]:
+            log.msg('unindexed query on %s: equality (%s), ranges (%s), '
+                    'sort (%s): %d queries, %.1fms mean, %.1fms max' % (
+                        name, ', '.join(equality), ', '.join(ranges),
+                        ', '.join('%s %d' % key for key in sort),
+                        shape.count, shape.total / shape.count * 1000,
+                        shape.slowest * 1000))
+
+    def start(self):
+        """ Ensures the indexes, then logs the report every
+        INDEX_REPORT_INTERVAL seconds.
+        """
+        self.ensure_indexes(config.AUTO_INDEXES).addErrback(log.err)
+        task.LoopingCall(self.report).start(config.INDEX_REPORT_INTERVAL,
+                                            now=False)
@@ -0,0 +1,249 @@
+""" Multi-process deployment.
+
+A supervisor process opens the listening socket and pre-forks the workers,
+which inherit it and all accept connections from the same queue, so every
+core of the box can serve requests without a load balancer in front.
+
+    python run.py --workers=0          # one worker per core
+    REST_WORKERS=4 python run.py
+
+Signals sent to the supervisor:
+
+- SIGHUP restarts the workers one after the other: a new worker is started
+  before the old one is asked to drain, so the socket is never left without
+  a process accepting on it, and the next one is only replaced once the old
+  one has exited.
+- SIGTERM and SIGINT drain the workers and exit.
+
+A worker which dies is started again.
+"""
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from cyclone import httpserver
+from twisted.internet import defer, protocol, reactor, task
+from twisted.python import log
+
+# a worker which dies sooner than this after being started is started again
+# after the same delay, so a broken worker doesn't make the supervisor spin.
+RESPAWN_DELAY = 1.0
+
+
+def worker_count(workers):
+    """ Returns the number of workers to start, one per core if `workers`
+    is 0.
+    """
+    if workers > 0:
+        return workers
+    return multiprocessing.cpu_count()
+
+
+def address_family(interface):
+    return socket.AF_INET6 if ':' in interface else socket.AF_INET
+
+
+def listen_socket(port, interface, backlog=128):
+    """ Returns a listening socket, to be shared by the workers. """
+    sock = socket.socket(address_family(interface), socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class HTTPConnection(httpserver.HTTPConnection):
+    """ An HTTP connection which keeps itself in the `connections` set of
+    the application, so the open connections can be drained on shutdown.
+    """
+    def connectionMade(self):
+        httpserver.HTTPConnection.connectionMade(self)
+        self.factory.connections.add(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+        httpserver.HTTPConnection.connectionLost(self, reason)
+
+    def drain(self):
+        """ Closes the connection now if it is idle, after the response to
+        the current request otherwise.
+        """
+        self.no_keep_alive = True
+        if self._request is None:
+            self.transport.loseConnection()
+
+
+@defer.inlineCallbacks
+def drain(port, application, timeout):
+    """ Stops accepting connections, then waits for the requests being
+    served to complete, for at most `timeout` seconds.
+
+    :param port: the listening port.
+    :param application: the :class:`cyclone.web.Application` being served.
+    :param timeout: the number of seconds to wait for.
+    """
+    yield port.stopListening()
+    for connection in list(application.connections):
+        connection.drain()
+
+    deadline = time.time() + timeout
+    while application.connections and time.time() < deadline:
+        yield task.deferLater(reactor, 0.1, lambda: None)
+    if application.connections:
+        log.msg('%d connections still open after %ds' % (
+            len(application.connections), timeout))
+
+
+def serve(application, options):
+    """ Serves `application`, on the socket inherited from the supervisor
+    when running as a worker and on its own one otherwise.
+
+    :param application: the :class:`cyclone.web.Application` to serve.
+    :param options: the parsed command line options.
+    """
+    fd = options["worker-fd"]
+    if fd is None:
+        port = reactor.listenTCP(options["port"], application,
+                                 interface=options["listen"])
+    else:
+        port = reactor.adoptStreamPort(
+            fd, address_family(options["listen"]), application)
+        # the reactor uses its own duplicate of the descriptor.
+        os.close(fd)
+
+        # the supervisor handles SIGHUP, and a terminal hangup reaches the
+        # whole process group.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        # exit along with the supervisor, if it gets killed.
+        parent = os.getppid()
+
+        def check_parent():
+            if os.getppid() != parent:
+                log.msg('supervisor is gone, exiting')
+                reactor.stop()
+        task.LoopingCall(check_parent).start(1.0, now=False)
+
+    reactor.addSystemEventTrigger('before', 'shutdown', drain, port,
+                                  application, options["drain-timeout"])
+    return port
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """ The supervisor side of a worker process. """
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.started = time.time()
+        self.retired = False
+        self.ended = defer.Deferred()
+
+    def signal(self, name):
+        try:
+            self.transport.signalProcess(name)
+        except Exception:
+            # the process has already exited.
+            pass
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+        self.ended.callback(None)
+
+
+class Supervisor(object):
+    """ Starts the workers and keeps them running.
+
+    :param options: the parsed command line options.
+    :param argv: the command line to start a worker with, the socket
+                 descriptor is appended to it.
+    """
+    def __init__(self, options, argv):
+        self.count = worker_count(options["workers"])
+        self.drain_timeout = options["drain-timeout"]
+        self.argv = argv
+        self.socket = listen_socket(options["port"], options["listen"])
+        self.workers = set()
+        self.stopping = self.restarting = False
+
+    def start(self):
+        for i in range(self.count):
+            self.spawn()
+        signal.signal(signal.SIGHUP,
+                      lambda *args: reactor.callFromThread(self.restart))
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        log.msg('supervising %d workers' % self.count)
+
+    def spawn(self):
+        fd = self.socket.fileno()
+        worker = WorkerProtocol(self)
+        reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable] + self.argv + ['--worker-fd', str(fd)],
+            env=os.environ, childFDs={0: 0, 1: 1, 2: 2, fd: fd})
+        self.workers.add(worker)
+        log.msg('worker %d started' % worker.transport.pid)
+        return worker
+
+    def worker_ended(self, worker, reason):
+        self.workers.discard(worker)
+        if worker.retired or self.stopping:
+            return
+        log.msg('worker exited unexpectedly: %s' % reason.getErrorMessage())
+        if time.time() - worker.started < RESPAWN_DELAY:
+            reactor.callLater(RESPAWN_DELAY, self._respawn)
+        else:
+            self.spawn()
+
+    def _respawn(self):
+        if not self.stopping:
+            self.spawn()
+
+    def retire(self, worker):
+        """ Asks a worker to drain and exit, killing it if it is still
+        running after the drain timeout.
+        """
+        worker.retired = True
+        worker.signal('TERM')
+        kill = reactor.callLater(self.drain_timeout + 5, worker.signal,
+                                 'KILL')
+        worker.ended.addCallback(
+            lambda _: kill.cancel() if kill.active() else None)
+        return worker.ended
+
+    @defer.inlineCallbacks
+    def restart(self):
+        """ Replaces the workers one at a time: a new worker is started and
+        given RESPAWN_DELAY seconds to come up, then the old one is retired,
+        and the next one waits until it has exited.
+        """
+        if self.restarting:
+            log.msg('already restarting the workers')
+            return
+        self.restarting = True
+        try:
+            workers = [worker for worker in self.workers if not worker.retired]
+            log.msg('restarting %d workers' % len(workers))
+            for worker in workers:
+                if self.stopping:
+                    break
+                if worker not in self.workers:
+                    # it died meanwhile, and was started again.
+                    continue
+                self.spawn()
+                yield task.deferLater(reactor, RESPAWN_DELAY, lambda: None)
+                if self.stopping:
+                    break
+                yield self.retire(worker)
+            else:
+                log.msg('restarted the workers')
+        finally:
+            self.restarting = False
+
+    def stop(self):
+        self.stopping = True
+        return defer.DeferredList(
+            [worker.ended if worker.retired else self.retire(worker)
+             for worker in list(self.workers)])
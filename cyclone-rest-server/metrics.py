@@ -0,0 +1,195 @@
+""" Request metrics: latency histograms per route and status, the time
+spent in each phase of the requests, and sampled profiles of the slow ones.
+
+Everything is recorded in-process and exposed on ``/metrics`` in the
+Prometheus text format. With several workers, each one has its own
+metrics.
+
+A profile covers the whole process from the start of the request to its
+end: the other requests the reactor serves while it waits on the database
+are in it too.
+"""
+from bisect import bisect_left
+import cProfile
+import os
+import time
+
+from twisted.python import log
+
+
+def log_linear_bounds(lowest, highest, sub_buckets):
+    """ Returns the upper bounds of HdrHistogram-like buckets: every power of
+    two from `lowest` up to `highest` is split into `sub_buckets` buckets of
+    the same width, which bounds the relative error of the recorded values
+    by 1 / `sub_buckets` whatever their magnitude.
+    """
+    bounds = [lowest]
+    base = lowest
+    while base < highest:
+        step = base / sub_buckets
+        bounds.extend(base + step * i for i in range(1, sub_buckets + 1))
+        base *= 2
+    return bounds
+
+
+# from 100us to about a minute, in seconds.
+BOUNDS = log_linear_bounds(0.0001, 60.0, 4)
+
+
+class Histogram(object):
+    """ Counts of the recorded values per bucket. """
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        # the last one counts the values above the highest bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """ Returns the upper bound of the bucket holding the given
+        percentile of the values, `None` if there are none.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) \
+                    else float('inf')
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                    for name, value in labels)
+
+
+class Metrics(object):
+    """ The histograms of an application, by name and labels.
+
+    :param profile_every: profile one request out of this many, 0 to never
+                          profile.
+    :param profile_slow: the duration, in seconds, from which a profiled
+                         request is slow and gets its profile dumped.
+    :param profile_dir: the directory of the profile dumps.
+    """
+    def __init__(self, profile_every=0, profile_slow=0.5, profile_dir=None):
+        self.histograms = {}
+        self.profile_every = profile_every
+        self.profile_slow = profile_slow
+        self.profile_dir = profile_dir
+        self._requests = 0
+        # cProfile can only profile one request at a time.
+        self._profiling = False
+
+    def histogram(self, name, labels):
+        """ Returns the histogram of a metric.
+
+        :param name: the metric name.
+        :param labels: a tuple of (name, value) label pairs.
+        """
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def timer(self):
+        """ Returns the timer of a new request. """
+        self._requests += 1
+        profiler = None
+        if self.profile_every and not self._profiling and \
+                self._requests % self.profile_every == 0:
+            self._profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return RequestTimer(self, profiler)
+
+    def record(self, timer, route, method, status):
+        """ Records the timings of a finished request.
+
+        :param timer: the :class:`RequestTimer` of the request.
+        :param route: the route which served the request.
+        :param method: the HTTP method.
+        :param status: the response status code.
+        """
+        total = timer.finish()
+        self.histogram('http_request_duration_seconds',
+                       (('route', route), ('method', method),
+                        ('status', status))).record(total)
+        # requests without phases would only repeat their total.
+        for phase, duration in timer.phases if len(timer.phases) > 1 else ():
+            self.histogram('http_request_phase_seconds',
+                           (('route', route), ('method', method),
+                            ('phase', phase))).record(duration)
+
+        if timer.profiler is not None:
+            self._profiling = False
+            if total >= self.profile_slow:
+                self._dump(timer.profiler, route, method, total)
+
+    def _dump(self, profiler, route, method, duration):
+        path = os.path.join(self.profile_dir, 'rest-%s-%s-%s-%dms.prof' % (
+            int(time.time() * 1000), method, route.strip('/').replace(
+                '/', '_') or 'root', duration * 1000))
+        try:
+            profiler.dump_stats(path)
+        except (IOError, OSError) as e:
+            log.msg('could not dump the profile of a slow request: %s' % e)
+        else:
+            log.msg('%s %s took %dms, profile of the whole process over '
+                    'that time dumped to %s' % (method, route,
+                                                duration * 1000, path))
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text format. """
+        lines = []
+        for name in sorted(set(key[0] for key in self.histograms)):
+            lines.append('# TYPE %s histogram' % name)
+            for (hname, labels), histogram in sorted(self.histograms.items()):
+                if hname != name:
+                    continue
+                prefix = _labels(labels)
+                cumulated = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulated += count
+                    lines.append('%s_bucket{%s,le="%.6g"} %d' % (
+                        name, prefix, bound, cumulated))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                    name, prefix, histogram.count))
+                lines.append('%s_sum{%s} %.6f' % (name, prefix,
+                                                  histogram.sum))
+                lines.append('%s_count{%s} %d' % (name, prefix,
+                                                  histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTimer(object):
+    """ Splits the duration of a request in phases, each one ending with a
+    call to :meth:`mark`.
+    """
+    def __init__(self, metrics, profiler=None):
+        self.metrics = metrics
+        self.profiler = profiler
+        self.phases = []
+        self.started = self._last = time.time()
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def finish(self):
+        """ Ends the last phase, writing the response, and returns the
+        duration of the request.
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.mark('write')
+        return self._last - self.started
@@ -0,0 +1,235 @@
+""" Compiles the client request into a backend query, so that filtering,
+sorting, projection and pagination all happen in the datastore and only the
+requested page and fields ever leave it.
+"""
+import ast
+import base64
+import binascii
+import json
+
+from bson import json_util
+
+from utils import config
+
+
+class QueryError(ValueError):
+    pass
+
+
+# the operators a ``?where`` filter may use, every data layer supports them.
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+FIELD_OPERATORS = ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin',
+                   '$exists')
+
+
+class Query(object):
+    """ A backend independent description of a find query. The `spec` and
+    `projection` follow the MongoDB syntax, which the in-memory data layer
+    emulates.
+    """
+    def __init__(self, spec=None, sort=None, projection=None, skip=0,
+                 limit=0):
+        # filter document, ``{}`` matches everything.
+        self.spec = spec or {}
+
+        # list of (field, direction) tuples, direction being 1 or -1.
+        self.sort = sort or []
+
+        # field projection, ``None`` returns whole documents.
+        self.projection = projection
+
+        self.skip = skip
+        self.limit = limit
+
+
+def build_query(req, rest_settings):
+    """ Returns the :class:`Query` for a parsed request. Raises
+    :class:`QueryError` when the request can't be honoured.
+
+    :param req: an instance of :class:`utils.ParsedRequest`.
+    :param rest_settings: the resource settings.
+    """
+    query = Query()
+
+    datasource_filter = rest_settings['datasource']['filter']
+    where = parse_where(req.where, rest_settings['allowed_filters'])
+    if datasource_filter and where:
+        query.spec = {'$and': [datasource_filter, where]}
+    else:
+        query.spec = datasource_filter or where
+
+    query.sort = parse_sort(req.sort)
+    query.projection = parse_projection(req.projection)
+
+    if rest_settings['pagination_mode'] == 'cursor':
+        # keyset pagination needs a total order, hence the id tie-breaker.
+        if config.ID_FIELD not in [field for field, _ in query.sort]:
+            query.sort.append((config.ID_FIELD, 1))
+        # the cursor of the next page is made of the sort fields.
+        if query.projection and any(query.projection.values()):
+            for field, _ in query.sort:
+                query.projection[field] = 1
+        elif query.projection:
+            for field, _ in query.sort:
+                query.projection.pop(field, None)
+            query.projection = query.projection or None
+        if req.cursor:
+            values = decode_cursor(req.cursor, query.sort)
+            keyset = keyset_spec(query.sort, values)
+            query.spec = {'$and': [query.spec, keyset]} if query.spec \
+                else keyset
+        # fetching one more document tells whether there is a next page,
+        # without a count query.
+        query.limit = req.max_results + 1 if req.max_results else 0
+    elif req.max_results:
+        query.skip = (req.page - 1) * req.max_results
+        query.limit = req.max_results
+
+    return query
+
+
+def keyset_spec(sort, values):
+    """ Returns the filter selecting the documents which come after the
+    sort key `values` in `sort` order. A page starting from a cursor costs
+    the same no matter how deep it is, unlike a skip.
+    """
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = dict((f, values[j]) for j, (f, _) in enumerate(sort[:i]))
+        clause[field] = {'$gt' if direction > 0 else '$lt': values[i]}
+        clauses.append(clause)
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+
+def encode_cursor(document, sort):
+    """ Returns the opaque token pointing right after `document` for the
+    given sort order.
+    """
+    payload = {'s': sort, 'v': [document.get(field) for field, _ in sort]}
+    token = base64.urlsafe_b64encode(
+        json_util.dumps(payload, separators=(',', ':')).encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, sort):
+    """ Returns the sort key values encoded in a cursor token, validating
+    that it was issued for the same sort order.
+    """
+    try:
+        token = token.encode('ascii')
+        payload = base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4))
+        payload = json.loads(payload.decode('utf-8'),
+                             object_hook=json_util.object_hook)
+        cursor_sort = [(field, direction) for field, direction
+                       in payload['s']]
+        values = payload['v']
+    except (ValueError, TypeError, KeyError, binascii.Error,
+            UnicodeError):
+        raise QueryError('malformed cursor')
+    if cursor_sort != sort or len(values) != len(sort):
+        raise QueryError('cursor does not match the requested sort')
+    return values
+
+
+def parse_where(where, allowed_filters):
+    """ Decodes the ``?where`` argument, a JSON filter document such as
+    ``{"user": "hanso"}``. MongoDB extended JSON (``{"$oid": ...}``) is
+    supported.
+    """
+    if not where:
+        return {}
+    try:
+        spec = json.loads(where, object_hook=json_util.object_hook)
+    except ValueError:
+        raise QueryError('where must be a JSON document')
+    if not isinstance(spec, dict):
+        raise QueryError('where must be a JSON document')
+    _check_operators(spec)
+    if '*' not in allowed_filters:
+        for field in _filter_fields(spec):
+            if field not in allowed_filters:
+                raise QueryError("filter on '%s' not allowed" % field)
+    return spec
+
+
+def _check_operators(spec):
+    """ Raises :class:`QueryError` when a filter uses an operator which is
+    not in LOGICAL_OPERATORS or FIELD_OPERATORS, such as ``$where``.
+    """
+    for key, value in spec.items():
+        if key in LOGICAL_OPERATORS:
+            if not isinstance(value, list) or not value or \
+                    not all(isinstance(clause, dict) for clause in value):
+                raise QueryError('%s takes a list of filters' % key)
+            for clause in value:
+                _check_operators(clause)
+        elif key.startswith('$'):
+            raise QueryError("operator '%s' not allowed" % key)
+        elif isinstance(value, dict) and \
+                any(op.startswith('$') for op in value):
+            for op in value:
+                if op not in FIELD_OPERATORS:
+                    raise QueryError("operator '%s' not allowed" % op)
+
+
+def _filter_fields(spec):
+    for key, value in spec.items():
+        if key in ('$and', '$or', '$nor'):
+            for sub_spec in value:
+                for field in _filter_fields(sub_spec):
+                    yield field
+        elif not key.startswith('$'):
+            yield key
+
+
+def parse_sort(sort):
+    """ Decodes the ``?sort`` argument. Both the ``[("lastname", -1)]``
+    syntax and the shorter ``-lastname,firstname`` one are supported.
+    """
+    if not sort:
+        return []
+    if sort.startswith('['):
+        try:
+            spec = ast.literal_eval(sort)
+            spec = [(str(field), int(direction)) for field, direction in spec]
+        except (ValueError, SyntaxError, TypeError):
+            raise QueryError('malformed sort')
+    else:
+        spec = []
+        for field in sort.split(','):
+            field = field.strip()
+            if field.startswith('-'):
+                spec.append((field[1:], -1))
+            elif field:
+                spec.append((field, 1))
+    for field, direction in spec:
+        if not field or direction not in (1, -1):
+            raise QueryError('malformed sort')
+    return spec
+
+
+def parse_projection(projection):
+    """ Decodes the ``?projection`` argument, a JSON document such as
+    ``{"user": 1}``. Despite projection, automatic fields are always
+    included.
+    """
+    if not projection:
+        return None
+    try:
+        spec = json.loads(projection)
+    except ValueError:
+        raise QueryError('projection must be a JSON document')
+    if not isinstance(spec, dict) or not spec:
+        raise QueryError('projection must be a JSON document')
+    values = set(bool(v) for k, v in spec.items() if k != config.ID_FIELD)
+    if len(values) > 1:
+        raise QueryError('projection cannot both include and exclude fields')
+    spec = dict((k, 1 if v else 0) for k, v in spec.items())
+    automatic = (config.ID_FIELD, 'updated', 'created', config.ETAG_FIELD)
+    if values == set([True]):
+        for field in automatic:
+            spec[field] = 1
+    else:
+        for field in automatic:
+            spec.pop(field, None)
+    return spec or None
@@ -0,0 +1,99 @@
+""" Resource registry. Everything that only depends on the configuration is
+computed once, when the application is created, so that the request
+handlers only have to fill in page numbers, cursors and ids.
+"""
+from utils import api_prefix, config, home_link, item_link, querydef
+from utils import resource_link, resource_uri, set_defaults
+from validation import compile_schema
+
+
+class FrozenDict(dict):
+    """ A dict which can't be modified after creation. """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('resource settings are read-only')
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+def freeze(value):
+    """ Returns a read-only copy of a settings value. """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+class Resource(object):
+    """ The settings and links of a resource.
+
+    :param name: the resource name, a key of `config.DOMAIN`.
+    """
+    def __init__(self, name):
+        self.name = name
+        settings = set_defaults(name)
+        self.validator = compile_schema(settings)
+        self.settings = freeze(settings)
+        self.source = self.settings['datasource']['source']
+
+        # the route of the resource endpoints, relative to the server root.
+        self.route = '%s/%s' % (api_prefix(), config.URLS[name])
+
+        self.uri = resource_uri(name)
+        self.home_link = freeze(home_link())
+        self.link = freeze(resource_link(name))
+
+        # item links only differ by their id.
+        template = item_link(name, '')
+        self._item_title = template['title']
+        self._item_href = template['href']
+
+    def item_link(self, item_id):
+        """ Returns the link to an item of the resource.
+
+        :param item_id: the item unique identifier.
+        """
+        return {'title': self._item_title,
+                'href': '%s%s' % (self._item_href, item_id)}
+
+    def page_href(self, req):
+        """ Returns the href of the collection pages for a request, up to
+        the page number which is to be appended.
+
+        :param req: an instance of :class:`utils.ParsedRequest`.
+        """
+        return '%s%s&page=' % (self.uri, querydef(req.max_results, req.where,
+                                                   req.sort))
+
+    def cursor_href(self, req, cursor):
+        """ Returns the href of the collection page starting at a cursor.
+
+        :param req: an instance of :class:`utils.ParsedRequest`.
+        :param cursor: the cursor token.
+        """
+        return '%s%s' % (self.uri, querydef(req.max_results, req.where,
+                                            req.sort, cursor=cursor))
+
+
+class ResourceRegistry(object):
+    """ All the resources of the API, by name. """
+    def __init__(self, names=None):
+        self._resources = {}
+        for name in names if names is not None else list(config.DOMAIN):
+            self.register(name)
+
+    def register(self, name):
+        resource = self._resources[name] = Resource(name)
+        return resource
+
+    def __getitem__(self, name):
+        return self._resources[name]
+
+    def __iter__(self):
+        return iter(self._resources.values())
+
+    def __len__(self):
+        return len(self._resources)
@@ -1,7 +1,18 @@
 import datetime
 import json
 from bson.objectid import ObjectId
-from utils import date_to_str
+from utils import config, date_to_str
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 
 class APIEncoder(json.JSONEncoder):
     """ Propretary JSONEconder subclass used by the json render function.
@@ -21,10 +32,97 @@ class APIEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def render_json(data):
+_api_encoder = APIEncoder()
+
+# exact type lookups for the special values, same conversions as
+# APIEncoder.default without going through its isinstance chain.
+_converters = {
+    datetime.datetime: date_to_str,
+    datetime.date: datetime.date.isoformat,
+    datetime.time: datetime.time.isoformat,
+    ObjectId: str,
+}
+
+
+def _default(obj):
+    try:
+        convert = _converters[type(obj)]
+    except KeyError:
+        # subclasses of the special types, or a TypeError for the rest.
+        return _api_encoder.default(obj)
+    return convert(obj)
+
+
+class JSONRenderer(object):
+    """ Standard library engine. Its output is byte for byte the one of
+    :class:`APIEncoder`.
+    """
+    name = 'json'
+
+    def render(self, data, sort_keys=True):
+        return json.dumps(data, default=_default,
+                          sort_keys=sort_keys).encode('utf-8')
+
+
+class OrjsonRenderer(JSONRenderer):
+    """ orjson engine. Only the special values reach the Python side, all
+    the rest is encoded in C. The output is compact and not ASCII-escaped,
+    so it is the same JSON document but not the same bytes as the standard
+    library engine.
+    """
+    name = 'orjson'
+
+    def render(self, data, sort_keys=True):
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(data, default=_default, option=option)
+        except orjson.JSONEncodeError:
+            # e.g. integers over 64 bits or non-string keys.
+            return JSONRenderer.render(self, data, sort_keys)
+
+
+class UjsonRenderer(JSONRenderer):
+    """ ujson (>= 5.0) engine. Compact output, otherwise escaped just like
+    the standard library engine does.
+    """
+    name = 'ujson'
+
+    def render(self, data, sort_keys=True):
+        try:
+            return ujson.dumps(data, default=_default, sort_keys=sort_keys,
+                               escape_forward_slashes=False).encode('utf-8')
+        except OverflowError:
+            return JSONRenderer.render(self, data, sort_keys)
+
+
+def get_renderer(engine='auto'):
+    """ Returns the renderer for a JSON engine, 'auto' picking the fastest
+    one installed.
+
+    :param engine: 'auto', 'orjson', 'ujson' or 'json'.
+    """
+    if engine in ('auto', 'orjson') and orjson is not None:
+        return OrjsonRenderer()
+    if engine in ('auto', 'ujson') and ujson is not None:
+        return UjsonRenderer()
+    if engine not in ('auto', 'json'):
+        raise ValueError('JSON engine %s is not available' % engine)
+    return JSONRenderer()
+
+
+renderer = get_renderer(config.JSON_ENGINE)
+
+
+def render_json(data, sort_keys=True):
     """ JSON render function
 
+    :param data: the data to render.
+    :param sort_keys: whether object keys get sorted, as resources might
+                      not need a stable key order.
+
     .. versionchanged:: 0.1.0
        Support for optional HATEOAS.
     """
-    return json.dumps(data, cls=APIEncoder, sort_keys=True)
+    return renderer.render(data, sort_keys)
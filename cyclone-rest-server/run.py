@@ -1,60 +1,485 @@
+import cyclone.redis
 import cyclone.web
+import json
+import math
+import os
 import sys
+import tempfile
+import time
 
+from datetime import datetime
+
+from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.python import log
-from common import last_updated, date_created 
-from utils import parse_request, item_etag, home_link, set_defaults #resource_link
+from twisted.python import usage
+from common import last_updated, date_created, epoch
+from compression import CompressedBodies, negotiate
+from datalayer import MemoryDataLayer, MongoDataLayer
+from events import HttpPublisher, RedisPublisher, delta
+from indexes import IndexAdvisor
+from query import QueryError, build_query, encode_cursor
+from cache import LRUCache, RedisResponseCache, ResponseCache
+from cache import response_key
+from launcher import HTTPConnection, Supervisor, serve
+from metrics import Metrics
+from registry import ResourceRegistry
+from utils import config, parse_request, collection_etag
+from utils import bson_decode, bson_encode, document_etag, fast_etag
+from utils import date_to_str, etag_matches, set_defaults
 from render import render_json
+from streaming import CollectionStreamer
+from transcode import UnsupportedType, render_page, transcode_document
 
 
 class CycloneRestHandler(cyclone.web.RequestHandler):
 
-    def initialize(self, rest_settings):
-        self.rest_settings = rest_settings
-    
+    def initialize(self, resource):
+        self.resource = resource
+        self.rest_settings = resource.settings
+        self.source = resource.source
+        # the encoding the response body gets, see _set_etag.
+        self.encoding = None
+        # requests failing before prepare(), e.g. with a 405, have none.
+        self.timer = None
+
+    def prepare(self):
+        metrics = self.application.metrics
+        self.timer = metrics.timer() if metrics is not None else None
+
+    def on_finish(self):
+        if self.timer is not None:
+            route = self.resource.route
+            if self.path_args and self.path_args[0]:
+                route += '/<id>'
+            self.application.metrics.record(self.timer, route,
+                                            self.request.method,
+                                            self.get_status())
+
+    def _mark(self, phase):
+        """ Ends a phase of the request, when metrics are enabled. """
+        if self.timer is not None:
+            self.timer.mark(phase)
+
+    @defer.inlineCallbacks
     def get(self, item_id=None):
         req = parse_request(self.request, self.rest_settings)
+        data = self.application.data
+        self._mark('parse')
 
         response = {}
+        documents_count = next_cursor = cache_key = None
 
-        data = [{"user": "hanso"}, {"user": "pie"}]
+        # the 'fast' ETags hash the BSON of the documents as the backend
+        # hands it over.
+        raw = config.ETAG_STRATEGY != 'sha1'
 
         if item_id:
-            items = [i for i in data if i["user"] == item_id]
+            lookup = {config.ID_FIELD: item_id.rstrip('/')}
+            if raw:
+                document = yield data.find_one_raw(self.source, **lookup)
+                item = None if document is None else bson_decode(document)
+            else:
+                document = None
+                item = yield data.find_one(self.source, **lookup)
+            self._mark('query')
+            if item is None:
+                raise cyclone.web.HTTPError(404)
+            item["updated"] = last_updated(item)
+            item["created"] = date_created(item)
+            etag = item['etag'] = self._etag(item, None, raw=document)
+            self._set_etag(etag)
+            self.set_header('Last-Modified', date_to_str(item["updated"]))
+            if self._not_modified(req, etag, item["updated"]):
+                # nothing gets rendered, let alone sent.
+                self.set_status(304)
+                return
+            items = [item]
         else:
-            items = data
+            try:
+                query = build_query(req, self.rest_settings)
+            except QueryError as e:
+                raise cyclone.web.HTTPError(400, str(e))
 
-        for item in items:
+            if req.stream:
+                yield self._stream(query)
+                return
 
-            item["updated"] = last_updated(item)
-            item["created"] = date_created(item)
-            item['etag'] = item_etag(item)
+            if self.rest_settings['response_cache_ttl']:
+                cache = self.application.response_cache
+                cache_key = response_key(query)
+                generation = yield cache.generation(self.resource.name)
+                cached = yield cache.get(self.resource.name, generation,
+                                         cache_key)
+                self._mark('cache')
+                if cached is not None:
+                    # no query, no rendering.
+                    self._write_response(req, *cached)
+                    return
+
+            started = time.time()
+            if raw:
+                items = yield data.find_raw(self.source, query)
+            else:
+                items = yield data.find(self.source, query)
+            self.application.index_advisor.observe(
+                self.resource, query, time.time() - started)
+
+            if req.max_results and \
+                    self.rest_settings['pagination_mode'] == 'cursor':
+                if len(items) > req.max_results:
+                    items = items[:req.max_results]
+                    next_cursor = encode_cursor(
+                        bson_decode(items[-1]) if raw else items[-1],
+                        query.sort)
+            elif query.limit and len(items) == query.limit:
+                # only a full page needs a count to know what comes next.
+                documents_count = yield data.count(self.source, query)
+            else:
+                documents_count = query.skip + len(items)
+            self._mark('query')
+
+            if raw:
+                items, etags = self._transcode(items, req.projection)
+            else:
+                for item in items:
+                    item["updated"] = last_updated(item)
+                    item["created"] = date_created(item)
+                    item['etag'] = self._etag(item, req.projection)
+                etags = [item['etag'] for item in items]
 
         response["items"] = items
+        self._mark('enrich')
+
+        response['links'] = self._pagination_links(self.resource, req,
+                                                   documents_count,
+                                                   next_cursor)
+        sort_keys = self.rest_settings['sort_keys']
+
+        if item_id:
+            body = render_json(response, sort_keys)
+            self._mark('render')
+            self._write_body(body, etag)
+            return
+
+        # a page only changes along with its items and links: a client
+        # which has it gets a 304 before anything is rendered.
+        etag = collection_etag(etags, req.projection or '',
+                               render_json(response['links']).decode('utf-8'))
+        self._set_etag(etag)
+        if etag_matches(req.if_none_match, etag):
+            self.set_status(304)
+            return
+
+        if raw:
+            body = render_page(items, response['links'], sort_keys)
+        else:
+            body = render_json(response, sort_keys)
+        self._mark('render')
+        if cache_key is not None:
+            cache.set(self.resource.name, generation, cache_key, body, etag,
+                      self.rest_settings['response_cache_ttl']
+                      ).addErrback(log.err)
+        self._write_body(body, etag)
+
+    def _transcode(self, documents, projection):
+        """ Returns the JSON of raw BSON documents, rendered as collection
+        items, and their ETags. Stored documents with their stored ETags go
+        from BSON to JSON without being decoded, with BSON_PASSTHROUGH. The
+        other documents, and those holding unsupported types, are decoded
+        and rendered the regular way.
+
+        :param documents: the BSON documents, as bytes.
+        :param projection: the projection they were retrieved with.
+        """
+        sort_keys = self.rest_settings['sort_keys']
+        passthrough = self.rest_settings['bson_passthrough'] and \
+            config.ETAG_STRATEGY == 'stored'
+        items, etags = [], []
+        for document in documents:
+            transcoded = None
+            if passthrough:
+                try:
+                    transcoded = transcode_document(document, sort_keys)
+                except UnsupportedType:
+                    pass
+            if transcoded is None:
+                item = bson_decode(document)
+                item["updated"] = last_updated(item)
+                item["created"] = date_created(item)
+                item['etag'] = self._etag(item, projection, raw=document)
+                transcoded = render_json(item, sort_keys), item['etag']
+            items.append(transcoded[0])
+            etags.append(transcoded[1])
+        return items, etags
 
-        response['links'] = self._pagination_links(None, None, len(items))
+    def _stream(self, query):
+        """ Streams every document matching the query, whatever the page
+        size, in bounded memory.
+        """
+        query.skip = query.limit = 0
+        raw = config.ETAG_STRATEGY != 'sha1'
+        cursor = self.application.data.cursor(self.source, query,
+                                              config.STREAM_BATCH_SIZE, raw)
+        sort_keys = self.rest_settings['sort_keys']
+
+        def render_item(document):
+            item = bson_decode(document) if raw else document
+            item["updated"] = last_updated(item)
+            item["created"] = date_created(item)
+            # not cached, an export would just flush the ETag cache.
+            item['etag'] = self._etag(item, None, cache=False,
+                                      raw=document if raw else None)
+            return render_json(item, sort_keys)
 
+        links = self._pagination_links(self.resource, None, None)
         self.set_header('Content-Type', 'application/json')
-        
-        self.write(render_json(response))
+        streamer = CollectionStreamer(self, cursor, render_item)
+        return streamer.stream(b'{"items": [',
+                               b'], "links": ' +
+                               render_json(links, sort_keys) + b'}')
+
+    @defer.inlineCallbacks
+    def post(self, item_id=None):
+        """ Inserts a document, or a JSON array of documents with a single
+        data layer operation. Documents are only inserted if they are all
+        valid, the response gives the status of each of them otherwise.
+        """
+        if item_id:
+            raise cyclone.web.HTTPError(405)
+        payload = self._body()
+        bulk = isinstance(payload, list)
+        documents = payload if bulk else [payload]
+        if not documents:
+            raise cyclone.web.HTTPError(400, 'no documents')
+
+        now = self._now()
+        issues = [self._validate(document) for document in documents]
+        if any(issues):
+            self.set_status(400)
+            statuses = [{'status': 'ERR', 'issues': issue} if issue
+                        else {'status': 'OK'} for issue in issues]
+            self._write_json(dict(statuses[0]) if not bulk else
+                             {'status': 'ERR', 'items': statuses})
+            return
+
+        for document in documents:
+            document["updated"] = document["created"] = now
+            self._store_etag(document)
+        ids = yield self.application.data.insert(self.source, documents)
+        yield self._invalidate()
+        self.set_status(201)
+        statuses = [self._status(id_, document)
+                    for id_, document in zip(ids, documents)]
+        for status, document in zip(statuses, documents):
+            self._publish('insert', status, {}, document)
+        self._write_json({'status': 'OK', 'items': statuses} if bulk
+                         else statuses[0])
+
+    @defer.inlineCallbacks
+    def put(self, item_id=None):
+        if not item_id:
+            raise cyclone.web.HTTPError(405)
+        item_id = item_id.rstrip('/')
+        original = yield self.application.data.find_one(
+            self.source, **{config.ID_FIELD: item_id})
+        if original is None:
+            raise cyclone.web.HTTPError(404)
+        document = self._body()
+        issues = self._validate(document)
+        if issues:
+            self.set_status(400)
+            self._write_json({'status': 'ERR', 'issues': issues})
+            return
+        document["created"] = date_created(original)
+        document["updated"] = self._now()
+        self._store_etag(document)
+        found = yield self.application.data.replace(self.source, item_id,
+                                                    document)
+        if not found:
+            raise cyclone.web.HTTPError(404)
+        yield self._invalidate()
+        status = self._status(original[config.ID_FIELD], document)
+        self._publish('replace', status, original, document)
+        self._write_json(status)
+
+    @defer.inlineCallbacks
+    def delete(self, item_id=None):
+        if not item_id:
+            raise cyclone.web.HTTPError(405)
+        found = yield self.application.data.remove(self.source,
+                                                   item_id.rstrip('/'))
+        if not found:
+            raise cyclone.web.HTTPError(404)
+        yield self._invalidate()
+        self._publish('delete', {config.ID_FIELD: item_id.rstrip('/')})
+        self.set_status(204)
+
+    def _body(self):
+        """ Decodes the JSON request body. """
+        try:
+            return json.loads(self.request.body)
+        except ValueError:
+            raise cyclone.web.HTTPError(400, 'malformed JSON body')
+
+    def _validate(self, document):
+        """ Validates a document sent by the client against the resource
+        schema, setting its default values. Returns the issues found, if
+        any.
+
+        :param document: the decoded document.
+        """
+        if not isinstance(document, dict):
+            return {'document': 'a JSON object is expected'}
+        document.pop(config.ID_FIELD, None)
+        # resources without a schema accept any document.
+        if self.resource.validator is not None:
+            return self.resource.validator.validate(document) or None
+        return None
+
+    def _invalidate(self):
+        """ Drops the cached responses of the resource, after a write. """
+        if self.rest_settings['response_cache_ttl']:
+            return self.application.response_cache.invalidate(
+                self.resource.name)
+        return defer.succeed(None)
+
+    def _publish(self, op, status, original=None, document=None):
+        """ Queues the change event of a write, if they are enabled.
+
+        :param op: 'insert', 'replace' or 'delete'.
+        :param status: the status of the written document.
+        :param original: the document replaced, `{}` for an insert.
+        :param document: the document written.
+        """
+        events = self.application.events
+        if events is None:
+            return
+        changes = None
+        if config.EVENTS_DELTA and document is not None:
+            changes = delta(original, document)
+        events.publish(self.resource.name, op, status, changes)
+
+    def _now(self):
+        # MongoDB stores dates with a millisecond resolution. Keeping all of
+        # it tells apart updates happening within the same second, which the
+        # ETag cache relies on.
+        now = datetime.utcnow()
+        return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+    def _etag(self, item, projection, cache=True, raw=None):
+        """ Returns the ETag of an item, the one stored along with it by
+        the 'stored' ETag strategy if any. Items only change along with
+        their `updated` field, so computed ETags are cached by id and last
+        update, and the item only gets serialized and hashed on a cache
+        miss. Items stored without an `updated` field, written outside the
+        API, get the epoch as last update whatever changes they go through:
+        their ETag is always computed.
 
-    def post(self, instance_id=None, action=None):
-        return self.rest_handler.post(instance_id=instance_id, action=action)
+        :param item: the item, with its `updated` and `created` fields set.
+        :param projection: the projection the item was retrieved with.
+        :param cache: whether to go through the ETag cache.
+        :param raw: the BSON of the item as read from the data layer, which
+                    the 'fast' strategy hashes as it is.
+        """
+        stored = item.pop(config.ETAG_FIELD, None)
+        if stored is not None and config.ETAG_STRATEGY == 'stored':
+            return stored
+        if not cache or item["updated"] == epoch():
+            return document_etag(item, raw)
+        key = (item.get(config.ID_FIELD), item["updated"], projection)
+        etag = self.application.etag_cache.get(key)
+        if etag is None:
+            etag = document_etag(item, raw)
+            self.application.etag_cache.set(key, etag)
+        return etag
+
+    def _store_etag(self, document):
+        """ Sets the ETag of a document about to be written, with the
+        'stored' ETag strategy.
+        """
+        document.pop(config.ETAG_FIELD, None)
+        if config.ETAG_STRATEGY == 'stored':
+            document[config.ETAG_FIELD] = fast_etag(document)
 
-    def put(self, instance_id):
-        return self.rest_handler.put(instance_id=instance_id)
+    def _not_modified(self, req, etag, updated):
+        """ Evaluates the conditional request headers. If-None-Match takes
+        precedence over If-Modified-Since (RFC 2616, 14.26).
+        """
+        if req.if_none_match:
+            return etag_matches(req.if_none_match, etag)
+        if req.if_modified_since:
+            return updated < req.if_modified_since
+        return False
+
+    def _status(self, id_, document):
+        """ Returns the status of a document which has been written. """
+        document[config.ID_FIELD] = id_
+        raw = None
+        if config.ETAG_STRATEGY == 'fast':
+            # the BSON the backend stores, `_id` first, which the reads
+            # hash.
+            raw = bson_encode(document)
+        return {'status': 'OK',
+                config.ID_FIELD: id_,
+                'updated': document['updated'],
+                'etag': self._etag(document, None, raw=raw),
+                'links': {'self': self.resource.item_link(id_)}}
 
-    def delete(self, instance_id):
-        return self.rest_handler.delete(instance_id=instance_id)
+    def _write_response(self, req, body, etag):
+        """ Writes a rendered collection response, or a 304 if the client
+        already has it.
+        """
+        self._set_etag(etag)
+        if etag_matches(req.if_none_match, etag):
+            self.set_status(304)
+            return
+        self._write_body(body, etag)
 
-    def _pagination_links(self, resource, req, documents_count):
+    def _set_etag(self, etag):
+        """ Sets the ETag of the response, 304s included, along with the
+        encoding the body gets. Every encoding being a representation of
+        its own, it has an ETag of its own: `etag` with the encoding as a
+        suffix, e.g. ``"<etag>-gzip"``.
+        """
+        if config.COMPRESSION:
+            self.set_header('Vary', 'Accept-Encoding')
+            self.encoding = negotiate(
+                self.request.headers.get('Accept-Encoding'))
+        # spelled 'Etag' as cyclone does: cyclone 1.1 only leaves alone the
+        # ETags set under that name, and adds a body-hashed one otherwise.
+        if self.encoding is not None:
+            self.set_header('Etag', '"%s-%s"' % (etag, self.encoding))
+        else:
+            self.set_header('Etag', '"%s"' % etag)
+
+    def _write_body(self, body, etag):
+        """ Writes a rendered JSON body, with the encoding `_set_etag`
+        negotiated if the body is large enough. Compressed bodies are cached
+        by ETag.
+        """
+        self.set_header('Content-Type', 'application/json')
+        if self.encoding is not None and \
+                len(body) >= config.COMPRESSION_MIN_SIZE:
+            body = self.application.compressed_bodies.get(
+                (self.resource.name, etag), body, self.encoding)
+            self.set_header('Content-Encoding', self.encoding)
+        self.write(body)
+
+    def _write_json(self, data):
+        self.set_header('Content-Type', 'application/json')
+        self.write(render_json(data, self.rest_settings['sort_keys']))
+
+    def _pagination_links(self, resource, req, documents_count,
+                          next_cursor=None):
         """Returns the appropriate set of resource links depending on the
         current page and the total number of documents returned by the query.
 
-        :param resource: the resource name.
+        :param resource: the :class:`registry.Resource`.
         :param req: and instace of :class:`eve.utils.ParsedRequest`.
         :param document_count: the number of documents returned by the query.
+        :param next_cursor: the token of the next page, for resources using
+                            cursor pagination.
 
         .. versionchanged:: 0.0.8
            Link to last page is provided if pagination is enabled (and the current
@@ -69,15 +494,17 @@ class CycloneRestHandler(cyclone.web.RequestHandler):
         .. versionchanged:: 0.0.3
            JSON links
         """
-        #_links = {'parent': home_link(), 'self': resource_link(resource)}
-        _links = {'parent': home_link()}
+        _links = {'parent': resource.home_link, 'self': resource.link}
 
-        """
-        if documents_count and config.DOMAIN[resource]['pagination']:
+        if next_cursor:
+            _links['next'] = {'title': 'next page',
+                              'href': resource.cursor_href(req, next_cursor)}
+
+        if documents_count and self.rest_settings['pagination']:
+            page_href = resource.page_href(req)
             if req.page * req.max_results < documents_count:
-                q = querydef(req.max_results, req.where, req.sort, req.page + 1)
-                _links['next'] = {'title': 'next page', 'href': '%s%s' %
-                                  (resource_uri(resource), q)}
+                _links['next'] = {'title': 'next page', 'href':
+                                  page_href + str(req.page + 1)}
 
                 # in python 2.x dividing 2 ints produces an int and that's rounded
                 # before the ceil call. Have to cast one value to float to get
@@ -86,34 +513,142 @@ class CycloneRestHandler(cyclone.web.RequestHandler):
                 # 1 if the modulo is non-zero...
                 last_page = int(math.ceil(documents_count
                                           / float(req.max_results)))
-                q = querydef(req.max_results, req.where, req.sort, last_page)
-                _links['last'] = {'title': 'last page', 'href': '%s%s'
-                                  % (resource_uri(resource), q)}
+                _links['last'] = {'title': 'last page',
+                                  'href': page_href + str(last_page)}
 
             if req.page > 1:
-                q = querydef(req.max_results, req.where, req.sort, req.page - 1)
-                _links['prev'] = {'title': 'previous page', 'href': '%s%s' %
-                                  (resource_uri(resource), q)}
-        """
+                _links['prev'] = {'title': 'previous page',
+                                  'href': page_href + str(req.page - 1)}
 
         return _links
 
 
-#class MyRestHandler(cyclone.web.RequestHandler, python_rest_handler.RestRequestHandler):
-#    data_manager = MongoDBDataManager
+class MetricsHandler(cyclone.web.RequestHandler):
+    """ Serves the request metrics in the Prometheus text format. """
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.application.metrics.render())
 
 
-if __name__ == "__main__":
-    handlers = [
-        #(r"/jobs/?", CycloneRestHandler, dict(rest_settings=set_defaults("/jobs"))),
-        (r"/jobs/?([A-Za-z0-9]+/?)?", CycloneRestHandler, dict(rest_settings=set_defaults("/jobs"))),
-        #(r"/jobs/?", CycloneRestHandler, dict(rest_settings=set_defaults("/jobs"))),
-        #(r"/jobs/([A-Za-z0-9]+)/?", CycloneRestHandler, dict(rest_settings={})),
-        #(r"/jobs/([A-Za-z0-9]+)/edit/?", CycloneRestHandler, dict(rest_settings={}))
-        #(r"/jobs/?", CycloneRestHandler)
+class Options(usage.Options):
+    optFlags = [
+        ["metrics", "m", "record request timings, served on /metrics"],
+    ]
+
+    optParameters = [
+        ["port", "p", 8888, "tcp port to listen on", int],
+        ["listen", "l", "127.0.0.1", "interface to listen on"],
+        ["workers", "w", int(os.environ.get("REST_WORKERS", 1)),
+         "number of worker processes, 0 for one per core", int],
+        ["drain-timeout", None, 30,
+         "seconds to wait for pending requests on shutdown", int],
+        ["worker-fd", None, None, "listening socket of a worker (internal)",
+         int],
+
+        ["data", None, "mongo", "data layer (mongo or memory)"],
+        ["response-cache", None, "memory",
+         "response cache (memory, per process, or redis)"],
+        ["redis-host", None, "127.0.0.1", "redis host"],
+        ["redis-port", None, 6379, "redis port", int],
+
+        ["events", None, None,
+         "publish change events to the SSE server (redis or http)"],
+        ["events-url", None, "http://127.0.0.1:8889/publish/batch",
+         "batch publish endpoint of the SSE server, for http events (the "
+         "SSE server listens on 8889 in cyclone_sse_server/start.sh)"],
+        ["events-secret", None, "", "http-secret of the SSE server"],
+
+        ["profile-every", None, 0,
+         "with --metrics, profile one request out of n, along with "
+         "whatever else the process runs meanwhile", int],
+        ["profile-slow", None, 0.5,
+         "seconds from which a profiled request gets its profile dumped",
+         float],
+        ["profile-dir", None, tempfile.gettempdir(),
+         "directory of the profile dumps"],
+
+        ["mongo-uri", None, config.MONGO_URI, "mongodb connection uri"],
+        ["mongo-dbname", None, config.MONGO_DBNAME, "mongodb database name"],
+        ["mongo-pool-size", None, config.MONGO_POOL_SIZE,
+         "number of pooled mongodb connections", int],
     ]
-    application = cyclone.web.Application(handlers)
+
+    def postOptions(self):
+        # a write only invalidates the memory cache of the worker taking
+        # it, the others would go on serving the previous pages.
+        if self["workers"] != 1 and self["response-cache"] == 'memory' and \
+                any(set_defaults(name)['response_cache_ttl']
+                    for name in config.DOMAIN):
+            raise usage.UsageError(
+                'the memory response cache is per process, use '
+                '--response-cache=redis with several workers')
+
+
+class App(cyclone.web.Application):
+    protocol = HTTPConnection
+
+    def __init__(self, settings):
+        self.connections = set()
+        self.resources = ResourceRegistry()
+
+        handlers = []
+        for resource in self.resources:
+            handlers.append((r"%s/?([A-Za-z0-9]+/?)?" % resource.route,
+                             CycloneRestHandler, dict(resource=resource)))
+
+        if settings["metrics"]:
+            self.metrics = Metrics(settings["profile-every"],
+                                   settings["profile-slow"],
+                                   settings["profile-dir"])
+            handlers.append((r"/metrics", MetricsHandler))
+        else:
+            self.metrics = None
+
+        if settings["data"] == 'memory':
+            data = MemoryDataLayer
+        else:
+            data = MongoDataLayer
+
+        self.data = data(settings)
+        self.etag_cache = LRUCache(config.ETAG_CACHE_SIZE)
+        self.index_advisor = IndexAdvisor(self.data, self.resources)
+        reactor.callWhenRunning(self.index_advisor.start)
+        self.compressed_bodies = CompressedBodies(
+            config.COMPRESSION_CACHE_SIZE)
+
+        if settings["response-cache"] == 'redis':
+            self.response_cache = RedisResponseCache(
+                cyclone.redis.lazyConnectionPool(settings["redis-host"],
+                                                 settings["redis-port"]))
+        else:
+            self.response_cache = ResponseCache(config.RESPONSE_CACHE_SIZE)
+
+        if settings["events"] == 'redis':
+            self.events = RedisPublisher(cyclone.redis.lazyConnection(
+                settings["redis-host"], settings["redis-port"]))
+        elif settings["events"] == 'http':
+            self.events = HttpPublisher(settings["events-url"],
+                                        settings["events-secret"])
+        else:
+            self.events = None
+        if self.events is not None:
+            # what is still queued goes out before exiting.
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                          self.events.flush)
+
+        cyclone.web.Application.__init__(self, handlers)
+
+
+if __name__ == "__main__":
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError as e:
+        sys.exit('%s\n%s' % (options, e))
 
     log.startLogging(sys.stdout)
-    reactor.listenTCP(8888, application, interface="127.0.0.1")
+    if options["worker-fd"] is None and options["workers"] != 1:
+        Supervisor(options, sys.argv).start()
+    else:
+        serve(App(options), options)
     reactor.run()
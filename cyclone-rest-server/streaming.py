@@ -0,0 +1,71 @@
+""" Streaming of collection responses, for exports and other requests
+asking for every document of a resource.
+"""
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+
+@implementer(IPushProducer)
+class CollectionStreamer(object):
+    """ Writes a collection response while the documents come out of a data
+    layer cursor, one batch at a time and with chunked transfer encoding.
+
+    Registered as a streaming producer on the connection, it stops pulling
+    batches whenever the transport buffer is full, so memory stays bounded
+    by the batch size whatever the size of the response and the speed of
+    the client.
+
+    :param handler: the :class:`cyclone.web.RequestHandler` to write to.
+    :param cursor: a data layer cursor.
+    :param render_item: returns the JSON bytes of a document.
+    """
+    def __init__(self, handler, cursor, render_item):
+        self.handler = handler
+        self.cursor = cursor
+        self.render_item = render_item
+        self._paused = None
+        self._stopped = False
+
+    def pauseProducing(self):
+        if self._paused is None:
+            self._paused = defer.Deferred()
+
+    def resumeProducing(self):
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.callback(None)
+
+    def stopProducing(self):
+        # the connection is gone.
+        self._stopped = True
+        self.resumeProducing()
+
+    @defer.inlineCallbacks
+    def stream(self, head, tail):
+        """ Writes `head`, the rendered documents separated by commas, then
+        `tail`. Fires once everything has been handed to the transport.
+        """
+        transport = self.handler.request.connection.transport
+        transport.registerProducer(self, True)
+        try:
+            self.handler.write(head)
+            self.handler.flush()
+            separator = b''
+            while not self._stopped and not self.cursor.exhausted:
+                if self._paused is not None:
+                    yield self._paused
+                    continue
+                batch = yield self.cursor.next_batch()
+                if not batch or self._stopped:
+                    continue
+                self.handler.write(separator + b','.join(
+                    [self.render_item(item) for item in batch]))
+                self.handler.flush()
+                separator = b','
+            if not self._stopped:
+                self.handler.write(tail)
+        finally:
+            transport.unregisterProducer()
+            if not self.cursor.exhausted:
+                self.cursor.close()
@@ -0,0 +1,188 @@
+""" Transcoding of raw BSON documents straight to JSON, for the collection
+reads which return the stored documents as they are.
+
+No Python dict is built along the way: the BSON buffer is walked by
+offset, and strings are copied out of it as they are unless they need
+escaping. Only the types the API stores are handled, the documents holding
+anything else raise :class:`UnsupportedType` and have to go through the
+regular path.
+"""
+import binascii
+import datetime
+import re
+import struct
+
+from render import render_json, renderer
+from utils import config, date_to_str
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_int32 = struct.Struct('<i')
+_int64 = struct.Struct('<q')
+_double = struct.Struct('<d')
+
+# same layout and escaping as the engine rendering the rest of the
+# responses: the bytes which can be copied into a JSON string as they are
+# include UTF-8 sequences with orjson only, which doesn't escape them.
+if renderer.name == 'json':
+    _COMMA, _COLON = b', ', b': '
+else:
+    _COMMA, _COLON = b',', b':'
+if renderer.name == 'orjson':
+    _plain = re.compile(b'[\\x20\\x21\\x23-\\x5b\\x5d-\\xff]*')
+else:
+    _plain = re.compile(b'[\\x20\\x21\\x23-\\x5b\\x5d-\\x7e]*')
+
+
+class UnsupportedType(ValueError):
+    """ A BSON type without a counterpart in the API responses. """
+
+
+def _json(value):
+    return renderer.render(value, False)
+
+
+def _string(data, start, end):
+    """ Returns the JSON string of the UTF-8 bytes ``data[start:end]``. """
+    if _plain.match(data, start, end).end() == end:
+        return b'"' + data[start:end] + b'"'
+    return _json(data[start:end].decode('utf-8'))
+
+
+def _date(millis):
+    """ Renders a BSON datetime the way `APIEncoder` renders a datetime. """
+    try:
+        date = _EPOCH + datetime.timedelta(milliseconds=millis)
+    except OverflowError:
+        # beyond the years a datetime holds, the regular path copes.
+        raise UnsupportedType('BSON datetime %d out of range' % millis)
+    return b'"' + date_to_str(date).encode('utf-8') + b'"'
+
+
+def _object(members, sort_keys):
+    """ Returns the JSON of the (key name, value JSON) pairs of an object.
+    The names are sorted as UTF-8 bytes, which is the order of their code
+    points, the order `render_json` sorts keys in.
+    """
+    if sort_keys:
+        members.sort()
+    return b'{' + _COMMA.join([_key(name) + _COLON + value
+                               for name, value in members]) + b'}'
+
+
+# the JSON of the keys met so far, by their BSON bytes: documents of a
+# collection share their keys.
+_keys = {}
+_KEYS_SIZE = 10000
+
+
+def _key(name):
+    key = _keys.get(name)
+    if key is None:
+        key = _string(name, 0, len(name))
+        if len(_keys) < _KEYS_SIZE:
+            _keys[name] = key
+    return key
+
+
+def _elements(data, offset, sort_keys, array=False):
+    """ Returns the JSON of the elements of the BSON document at `offset`:
+    values for an array, (key name, value) pairs otherwise.
+    """
+    end = offset + _int32.unpack_from(data, offset)[0] - 1
+    offset += 4
+    elements = []
+    append = elements.append
+    while offset < end:
+        kind = data[offset:offset + 1]
+        name_end = data.index(b'\x00', offset + 1)
+        name = data[offset + 1:name_end]
+        offset = name_end + 1
+        # the common scalar types are inlined, function calls being most
+        # of the cost of the loop.
+        if kind == b'\x02':
+            size = _int32.unpack_from(data, offset)[0]
+            start, offset = offset + 4, offset + 4 + size
+            # the size includes the trailing NUL.
+            if _plain.match(data, start, offset - 1).end() == offset - 1:
+                value = b'"' + data[start:offset - 1] + b'"'
+            else:
+                value = _json(data[start:offset - 1].decode('utf-8'))
+        elif kind == b'\x10':
+            value = str(_int32.unpack_from(data, offset)[0]).encode('ascii')
+            offset += 4
+        elif kind == b'\x07':
+            value = b'"' + binascii.hexlify(data[offset:offset + 12]) + b'"'
+            offset += 12
+        else:
+            value, offset = _value(kind, data, offset, sort_keys)
+        append(value if array else (name, value))
+    return elements
+
+
+def _value(kind, data, offset, sort_keys):
+    """ Returns the JSON of the BSON value of type `kind` at `offset`, and
+    the offset right after it.
+    """
+    if kind == b'\x09':
+        return _date(_int64.unpack_from(data, offset)[0]), offset + 8
+    if kind == b'\x03':
+        size = _int32.unpack_from(data, offset)[0]
+        return (_object(_elements(data, offset, sort_keys), sort_keys),
+                offset + size)
+    if kind == b'\x04':
+        size = _int32.unpack_from(data, offset)[0]
+        return (b'[' + _COMMA.join(_elements(data, offset, sort_keys, True)) +
+                b']', offset + size)
+    if kind == b'\x01':
+        return _json(_double.unpack_from(data, offset)[0]), offset + 8
+    if kind == b'\x08':
+        return (b'false' if data[offset:offset + 1] == b'\x00' else b'true',
+                offset + 1)
+    if kind == b'\x0a':
+        return b'null', offset
+    if kind == b'\x12':
+        return (str(_int64.unpack_from(data, offset)[0]).encode('ascii'),
+                offset + 8)
+    raise UnsupportedType('BSON type 0x%s' % binascii.hexlify(kind).decode(
+        'ascii'))
+
+
+def transcode_document(data, sort_keys=True):
+    """ Returns the JSON of a raw BSON document as a collection item, and its
+    ETag: the one stored in ETAG_FIELD, which gets rendered as `etag`.
+    Missing `updated` and `created` dates default to the epoch, just like
+    `last_updated` and `date_created` do. Returns `None` for the documents
+    without a stored ETag.
+
+    :param data: the BSON document, as bytes.
+    :param sort_keys: whether object keys get sorted.
+    """
+    etag_name = config.ETAG_FIELD.encode('utf-8')
+    members = []
+    etag = None
+    for name, value in _elements(data, 0, sort_keys):
+        if name == etag_name:
+            etag = value
+        else:
+            members.append((name, value))
+    if etag is None:
+        return None
+
+    names = set(name for name, _ in members)
+    for field in (b'updated', b'created'):
+        if field not in names:
+            members.append((field, _date(0)))
+    members.append((b'etag', etag))
+    return _object(members, sort_keys), etag[1:-1].decode('ascii')
+
+
+def render_page(items, links, sort_keys=True):
+    """ Returns the JSON of a collection page from the JSON of its items.
+
+    :param items: the rendered items.
+    :param links: the links of the page.
+    :param sort_keys: whether object keys get sorted.
+    """
+    return (b'{"items"' + _COLON + b'[' + _COMMA.join(items) + b']' +
+            _COMMA + b'"links"' + _COLON + render_json(links, sort_keys) +
+            b'}')
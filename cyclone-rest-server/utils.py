@@ -1,14 +1,42 @@
 from datetime import datetime, timedelta
+from functools import partial
 import hashlib
 from bson.json_util import dumps
+from bson.son import SON
+import bson
+from dates import RFC1123_FORMAT, format_date, parse_date
+
+try:
+    import xxhash
+    _fast_hash = xxhash.xxh64
+except ImportError:
+    xxhash = None
+    # blake2b is in the standard library from python 3.6, md5 is the
+    # fastest hashlib has before that.
+    if hasattr(hashlib, 'blake2b'):
+        _fast_hash = partial(hashlib.blake2b, digest_size=16)
+    else:
+        _fast_hash = hashlib.md5
+
+# bson.encode and bson.decode appeared with pymongo 3.9.
+bson_encode = getattr(bson, 'encode', None) or bson.BSON.encode
+bson_decode = getattr(bson, 'decode', None) or \
+    (lambda data: bson.BSON(data).decode())
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
 
 class Config(object):
     # RFC 1123 (ex RFC 822)
-    DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
+    DATE_FORMAT = RFC1123_FORMAT
     SERVER_NAME = '127.0.0.1:5000'
     DOMAIN = {
         '/jobs': {},
     }
+    # resource urls, relative to the api prefix. Filled by set_defaults.
+    URLS = {}
     URL_PREFIX = ""
     API_VERSION = ""
     ITEM_METHODS = ['GET']
@@ -18,8 +46,65 @@ class Config(object):
     PAGINATION = True               # pagination enabled by default.
     PAGINATION_LIMIT = 50
     PAGINATION_DEFAULT = 25
+    # 'page' (?page=n) or 'cursor' (keyset pagination, ?cursor=token)
+    PAGINATION_MODE = 'page'
     SORTING = True                  # sorting enabled by default.
+    STREAMING = False               # ?stream=1, opt-in per resource.
+    STREAM_BATCH_SIZE = 100
     EMBEDDING = True                # embedding enabled by default
+    ALLOW_UNKNOWN = False           # fields missing from the schema
+
+    ID_FIELD = '_id'
+
+    # 'auto' picks the fastest installed of 'orjson', 'ujson' and 'json'.
+    JSON_ENGINE = 'auto'
+    JSON_SORT_KEYS = True
+
+    # 'sha1' hashes the JSON of the items, 'fast' their BSON as the backend
+    # hands it over with a fast hash, 'stored' computes the ETags of documents when they are written
+    # and stores them in ETAG_FIELD ('fast' for documents without one).
+    ETAG_STRATEGY = 'sha1'
+    ETAG_FIELD = '_etag'
+    # with stored ETags, collection reads transcode the BSON documents
+    # of the backend straight to JSON.
+    BSON_PASSTHROUGH = True
+
+    # number of (id, updated) ETags kept by the conditional GET path.
+    ETAG_CACHE_SIZE = 10000
+
+    # rendered collection responses, kept for RESPONSE_CACHE_TTL seconds.
+    # 0 disables the response cache.
+    RESPONSE_CACHE_SIZE = 1000
+    RESPONSE_CACHE_TTL = 0
+
+    # change events of the writes (see events.py), sent every
+    # EVENTS_INTERVAL seconds. The oldest ones are dropped past
+    # EVENTS_QUEUE_SIZE, EVENTS_DELTA adds the changed fields to them.
+    EVENTS_INTERVAL = 0.05
+    EVENTS_QUEUE_SIZE = 10000
+    EVENTS_DELTA = False
+
+    # bodies of at least COMPRESSION_MIN_SIZE bytes are sent compressed to
+    # the clients accepting gzip, or brotli when it is installed. The
+    # compressed bodies are kept by ETag, up to COMPRESSION_CACHE_SIZE
+    # bytes of them.
+    COMPRESSION = True
+    COMPRESSION_MIN_SIZE = 1024
+    COMPRESSION_CACHE_SIZE = 64 * 1024 * 1024
+    GZIP_LEVEL = 6
+    BROTLI_QUALITY = 5
+
+    # the indexes the resources need are created at startup, or only
+    # logged when missing with AUTO_INDEXES = False. The query shapes no
+    # index serves are logged every INDEX_REPORT_INTERVAL seconds, the
+    # INDEX_REPORT_SIZE most frequent ones.
+    AUTO_INDEXES = True
+    INDEX_REPORT_INTERVAL = 300
+    INDEX_REPORT_SIZE = 20
+
+    MONGO_URI = 'mongodb://127.0.0.1:27017'
+    MONGO_DBNAME = 'codekitchen'
+    MONGO_POOL_SIZE = 10
 
 config = Config()
 
@@ -70,16 +155,26 @@ def set_defaults(resource):
     .. versionchanged:: 0.0.3
        `item_title` default value.
     """
-    settings = {}
+    settings = config.DOMAIN.setdefault(resource, {})
 
-    settings.setdefault('url', resource)
+    settings.setdefault('url', resource.strip('/'))
+    config.URLS[resource] = settings['url']
+    settings.setdefault('item_title',
+                        settings['url'].rstrip('s').capitalize())
 
     settings.setdefault('allowed_filters',
                         config.ALLOWED_FILTERS)
     settings.setdefault('sorting', config.SORTING)
     settings.setdefault('embedding', config.EMBEDDING)
     settings.setdefault('pagination', config.PAGINATION)
+    settings.setdefault('pagination_mode', config.PAGINATION_MODE)
     settings.setdefault('projection', config.PROJECTION)
+    settings.setdefault('sort_keys', config.JSON_SORT_KEYS)
+    settings.setdefault('streaming', config.STREAMING)
+    settings.setdefault('response_cache_ttl', config.RESPONSE_CACHE_TTL)
+    settings.setdefault('bson_passthrough', config.BSON_PASSTHROUGH)
+    # extra indexes, as lists of (field, direction) pairs.
+    settings.setdefault('indexes', [])
     # TODO make sure that this we really need the test below
     #if settings['item_lookup']:
     #    item_methods = config.ITEM_METHODS
@@ -90,6 +185,7 @@ def set_defaults(resource):
 
     # empty schemas are allowed for read-only access to resources
     schema = settings.setdefault('schema', {})
+    settings.setdefault('allow_unknown', config.ALLOW_UNKNOWN)
     #self.set_schema_defaults(schema)
 
     datasource = {}
@@ -156,6 +252,15 @@ class ParsedRequest(object):
     # `embedded` value of the query string (?embedded). Defaults to None.
     embedded = None
 
+    # `cursor` value of the query string (?cursor), only honoured by
+    # resources using cursor pagination. Defaults to None.
+    cursor = None
+
+    # `stream` value of the query string (?stream). When true every
+    # matching document is streamed, regardless of pagination. Defaults to
+    # False.
+    stream = False
+
 
 def parse_request(request, rest_settings):
     """ Parses a client request, returning instance of :class:`ParsedRequest`
@@ -178,27 +283,32 @@ def parse_request(request, rest_settings):
     r = ParsedRequest()
 
     if rest_settings['allowed_filters']:
-        r.where = args.get('where')
+        r.where = _argument(args, 'where')
     if rest_settings['projection']:
-        r.projection = args.get('projection')
+        r.projection = _argument(args, 'projection')
     if rest_settings['sorting']:
-        r.sort = args.get('sort')
+        r.sort = _argument(args, 'sort')
     if rest_settings['embedding']:
-        r.embedded = args.get('embedded')
+        r.embedded = _argument(args, 'embedded')
+
+    if rest_settings['streaming']:
+        r.stream = _argument(args, 'stream') in ('1', 'true')
 
-    #max_results_default = config.PAGINATION_DEFAULT if \
-    #    rest_settings['pagination'] else 0
-    #try:
-    #    r.max_results = int(float(args['max_results']))
-    #    assert r.max_results > 0
-    #except (ValueError, AssertionError):
-    #    r.max_results = max_results_default
+    max_results_default = config.PAGINATION_DEFAULT if \
+        rest_settings['pagination'] else 0
+    try:
+        r.max_results = int(float(_argument(args, 'max_results')))
+        assert r.max_results > 0
+    except (TypeError, ValueError, AssertionError):
+        r.max_results = max_results_default
 
     if rest_settings['pagination']:
         # TODO should probably return a 400 if 'page' is < 1 or non-numeric
-        if 'page' in args:
+        if rest_settings['pagination_mode'] == 'cursor':
+            r.cursor = _argument(args, 'cursor')
+        elif 'page' in args:
             try:
-                r.page = abs(int(args.get('page'))) or 1
+                r.page = abs(int(_argument(args, 'page'))) or 1
             except ValueError:
                 pass
 
@@ -208,7 +318,11 @@ def parse_request(request, rest_settings):
             r.max_results = config.PAGINATION_LIMIT
 
     if headers:
-        r.if_modified_since = weak_date(headers.get('If-Modified-Since'))
+        try:
+            r.if_modified_since = weak_date(headers.get('If-Modified-Since'))
+        except ValueError:
+            # invalid dates must be ignored (RFC 2616, 14.25).
+            pass
         # TODO if_none_match and if_match should probably be validated as
         # valid etags, returning 400 on fail. Not sure however since
         # we're just going to use these for string-type comparision
@@ -218,6 +332,17 @@ def parse_request(request, rest_settings):
     return r
 
 
+def _argument(args, name):
+    """ Returns the (last) value of a query string argument as a string, or
+    `None` if the argument is missing. cyclone keeps them as lists of bytes.
+    """
+    values = args.get(name)
+    if not values:
+        return None
+    value = values[-1]
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
 def weak_date(date):
     """ Returns a RFC-1123 string corresponding to a datetime value plus
     a 1 second timedelta. This is needed because when saved, documents
@@ -234,7 +359,11 @@ def str_to_date(string):
 
     :param string: the RFC-1123 string to convert to datetime value.
     """
-    return datetime.strptime(string, config.DATE_FORMAT) if string else None
+    if not string:
+        return None
+    if config.DATE_FORMAT == RFC1123_FORMAT:
+        return parse_date(string)
+    return datetime.strptime(string, config.DATE_FORMAT)
 
 
 def date_to_str(date):
@@ -242,7 +371,11 @@ def date_to_str(date):
 
     :param date: the datetime value to convert.
     """
-    return datetime.strftime(date, config.DATE_FORMAT) if date else None
+    if not date:
+        return None
+    if config.DATE_FORMAT == RFC1123_FORMAT:
+        return format_date(date)
+    return datetime.strftime(date, config.DATE_FORMAT)
 
 
 def item_etag(value):
@@ -259,6 +392,105 @@ def item_etag(value):
     return h.hexdigest()
 
 
+def fast_etag(item):
+    """ Computes the ETag of an item about to be written from its BSON
+    encoding, with a fast non-cryptographic hash: much cheaper than
+    `item_etag` which goes through JSON. The fields are hashed in sorted
+    order, as the data layers don't all keep them in the order they were
+    written in.
+
+    :param item: the item to compute the ETag of.
+    """
+    return _fast_hash(bson_encode(SON(sorted(item.items())))).hexdigest()
+
+
+def raw_etag(data):
+    """ Computes the ETag of a stored document from the BSON the data layer
+    handed over, hashed as it is: the document is neither decoded nor
+    encoded again.
+
+    :param data: the BSON document, as bytes.
+    """
+    return _fast_hash(data).hexdigest()
+
+
+def document_etag(item, raw=None):
+    """ Computes the ETag of an item with the configured strategy.
+
+    :param item: the item to compute the ETag of.
+    :param raw: the BSON of the stored item, if the data layer handed it
+                over.
+    """
+    if config.ETAG_STRATEGY == 'sha1':
+        return item_etag(item)
+    if raw is not None:
+        return raw_etag(raw)
+    return fast_etag(item)
+
+
+def collection_etag(etags, *parts):
+    """ Computes the ETag of a collection page from the ETags of its
+    items and the other `parts` of the response, so a matching
+    If-None-Match can be answered before the page gets rendered.
+
+    :param etags: the ETags of the items of the page.
+    :param parts: strings describing the rest of the response.
+    """
+    h = _fast_hash()
+    for etag in etags:
+        h.update(etag.encode('ascii'))
+    for part in parts:
+        h.update(b'\0' + part.encode('utf-8'))
+    return h.hexdigest()
+
+
+def querydef(max_results=config.PAGINATION_DEFAULT, where=None, sort=None,
+             page=None, cursor=None):
+    """ Returns a valid query string.
+
+    :param max_results: `max_result` part of the query string. Defaults to
+                        `PAGINATION_DEFAULT`
+    :param where: `where` part of the query string. Defaults to None.
+    :param sort: `sort` part of the query string. Defaults to None.
+    :param page: `page` part of the query string. Defaults to None.
+    :param cursor: `cursor` part of the query string. Defaults to None.
+    """
+    args = [('max_results', max_results)]
+    for name, value in (('where', where), ('sort', sort), ('page', page),
+                        ('cursor', cursor)):
+        if value:
+            args.append((name, value))
+    return '?' + urlencode(args)
+
+
+# the suffixes of the ETags of compressed bodies.
+ENCODING_SUFFIXES = ('-gzip', '-br')
+
+
+def etag_matches(if_none_match, etag):
+    """ Returns `True` if the `If-None-Match` header value matches the ETag,
+    using the weak comparison function as RFC 2616 mandates for GETs. The
+    ETags of the compressed representations, with an encoding suffix such
+    as ``"<etag>-gzip"``, match too.
+
+    :param if_none_match: the header value, a list of possibly weak ETags.
+    :param etag: the current ETag of the resource.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        candidate = candidate.strip('"')
+        if candidate == etag or (candidate.startswith(etag) and
+                                 candidate[len(etag):] in ENCODING_SUFFIXES):
+            return True
+    return False
+
+
 def resource_link(resource):
     """ Returns a link to a resource endpoint.
 
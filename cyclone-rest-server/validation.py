@@ -0,0 +1,253 @@
+""" Validation of the documents sent by clients against the resource schemas,
+which use a subset of the Cerberus grammar:
+
+    'schema': {
+        'firstname': {
+            'type': 'string',
+            'minlength': 1,
+            'maxlength': 10,
+            'required': True,
+        },
+    }
+
+Supported rules are `type`, `required`, `nullable`, `default`,
+`minlength`, `maxlength`, `min`, `max`, `allowed`, `regex` and `schema`
+(the rules of the fields of a `dict` field, or of the items of a `list`
+field).
+
+Schemas are compiled once, when the resource registry is built: every
+field definition becomes a list of checks which only test what the
+definition asks for, so validating a document doesn't go through the rule
+dicts again.
+"""
+import copy
+from datetime import datetime
+import re
+
+from bson.objectid import ObjectId
+
+from dates import parse_date
+
+try:
+    string_types = basestring
+    integer_types = (int, long)
+except NameError:
+    string_types = str
+    integer_types = int
+
+
+def _is_integer(value):
+    return isinstance(value, integer_types) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    return (isinstance(value, integer_types) or isinstance(value, float)) \
+        and not isinstance(value, bool)
+
+
+_types = {
+    'string': lambda value: isinstance(value, string_types),
+    'integer': _is_integer,
+    'float': lambda value: isinstance(value, float),
+    'number': _is_number,
+    'boolean': lambda value: isinstance(value, bool),
+    'datetime': lambda value: isinstance(value, datetime),
+    'dict': lambda value: isinstance(value, dict),
+    'list': lambda value: isinstance(value, list),
+    'objectid': lambda value: isinstance(value, ObjectId),
+}
+
+# JSON has neither dates nor ids: string values of those fields are
+# converted.
+_converters = {
+    'datetime': parse_date,
+    'objectid': ObjectId,
+}
+
+
+class SchemaError(ValueError):
+    """ Raised when a resource schema can't be compiled. """
+
+
+class Validator(object):
+    """ Validates documents against a resource schema.
+
+    :param schema: the resource schema.
+    :param allow_unknown: whether fields missing from the schema are
+                          accepted.
+    :param defaults: the names of the fields with a default value, which
+                     is set on documents missing them.
+    """
+    def __init__(self, schema, allow_unknown=False, defaults=None):
+        self.allow_unknown = allow_unknown
+        self.fields = frozenset(schema)
+        self.required = [field for field in sorted(schema)
+                         if schema[field].get('required')]
+        self.defaults = [(field, schema[field]['default'])
+                         for field in sorted(defaults or ())]
+        self.checks = dict((field, _compile_field(definition))
+                           for field, definition in schema.items())
+
+    def validate(self, document):
+        """ Sets the default values missing from `document`, then returns
+        the issues found in it, by field. Empty if the document is valid.
+
+        :param document: the document to validate.
+        """
+        errors = {}
+        self._validate(document, '', errors)
+        return errors
+
+    def _validate(self, document, prefix, errors):
+        for field, default in self.defaults:
+            if field not in document:
+                document[field] = copy.deepcopy(default) \
+                    if isinstance(default, (dict, list)) else default
+
+        if not self.allow_unknown and not self.fields.issuperset(document):
+            for field in document:
+                if field not in self.fields:
+                    errors[prefix + field] = 'unknown field'
+
+        checks = self.checks
+        for field, value in document.items():
+            check = checks.get(field)
+            if check is not None:
+                check(document, field, value, prefix + field, errors)
+
+        for field in self.required:
+            if field not in document:
+                errors[prefix + field] = 'required field'
+
+
+def compile_schema(settings):
+    """ Returns the validator of a resource, `None` if it has no schema
+    and accepts any document.
+
+    :param settings: the resource settings, as filled by `set_defaults`.
+    """
+    if not settings['schema']:
+        return None
+    return Validator(settings['schema'], settings['allow_unknown'],
+                     settings['defaults'])
+
+
+def _compile_field(definition):
+    """ Returns a function checking the value of a field against its
+    definition, which adds its issues to an `errors` dict.
+    """
+    nullable = definition.get('nullable', False)
+    type_ = definition.get('type')
+    convert = _converters.get(type_)
+    if type_ is not None and type_ not in _types:
+        raise SchemaError('unknown type %r' % type_)
+    is_type = _types.get(type_)
+    rules = _compile_rules(definition)
+
+    nested = definition.get('schema')
+    if nested is None:
+        check_nested = None
+    elif type_ == 'list':
+        check_nested = _compile_items(_compile_field(nested))
+    else:
+        check_nested = Validator(nested)._validate
+
+    def check(document, field, value, name, errors):
+        if value is None:
+            if not nullable:
+                errors[name] = 'null value not allowed'
+            return
+        if convert is not None and isinstance(value, string_types):
+            try:
+                value = document[field] = convert(value)
+            except Exception:
+                pass
+        if is_type is not None and not is_type(value):
+            errors[name] = 'must be of %s type' % type_
+            return
+        for rule in rules:
+            message = rule(value)
+            if message is not None:
+                errors[name] = message
+        if check_nested is not None:
+            if isinstance(value, dict):
+                check_nested(value, name + '.', errors)
+            elif isinstance(value, list):
+                check_nested(value, name, errors)
+
+    return check
+
+
+def _compile_items(check):
+    def check_items(items, name, errors):
+        for i, item in enumerate(items):
+            check(items, i, item, '%s.%d' % (name, i), errors)
+    return check_items
+
+
+def _compile_rules(definition):
+    """ Returns the checks of the value rules of a field definition, each
+    returning an error message or `None`.
+    """
+    rules = []
+
+    if 'minlength' in definition:
+        rules.append(_min_length(definition['minlength']))
+    if 'maxlength' in definition:
+        rules.append(_max_length(definition['maxlength']))
+    if 'min' in definition:
+        rules.append(_min_value(definition['min']))
+    if 'max' in definition:
+        rules.append(_max_value(definition['max']))
+    if 'allowed' in definition:
+        rules.append(_allowed(definition['allowed']))
+    if 'regex' in definition:
+        rules.append(_regex(definition['regex']))
+
+    return rules
+
+
+def _min_length(minlength):
+    message = 'min length is %d' % minlength
+    return lambda value: message if hasattr(value, '__len__') and \
+        len(value) < minlength else None
+
+
+def _max_length(maxlength):
+    message = 'max length is %d' % maxlength
+    return lambda value: message if hasattr(value, '__len__') and \
+        len(value) > maxlength else None
+
+
+def _min_value(minimum):
+    message = 'min value is %r' % (minimum,)
+    return lambda value: message if value < minimum else None
+
+
+def _max_value(maximum):
+    message = 'max value is %r' % (maximum,)
+    return lambda value: message if value > maximum else None
+
+
+def _allowed(allowed):
+    try:
+        allowed = frozenset(allowed)
+    except TypeError:
+        pass
+
+    def check(value):
+        try:
+            if value in allowed:
+                return None
+        except TypeError:
+            # an unhashable value, not in the set.
+            pass
+        return 'unallowed value %r' % (value,)
+    return check
+
+
+def _regex(regex):
+    pattern = re.compile(regex + '$')
+    message = 'value does not match regex %r' % regex
+    return lambda value: message if isinstance(value, string_types) and \
+        not pattern.match(value) else None
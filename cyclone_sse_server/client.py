@@ -1,5 +1,9 @@
 from sseclient import SSEClient
 
-messages = SSEClient('http://localhost:8888')
+messages = SSEClient('http://localhost:8889')
 for msg in messages:
+    # sseclient reconnects with the Last-Event-ID of the last message, the
+    # server replays what was missed or asks for a resync.
+    if msg.event == 'resync':
+        print 'missed events are gone, reload the state'
     print msg.__dict__
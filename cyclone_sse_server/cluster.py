@@ -0,0 +1,271 @@
+""" Multi-process deployment of the SSE server.
+
+The node process opens the listening socket and the only broker
+connection of the box, then starts the workers: they inherit the socket
+and all accept connections from it, and get the broker messages relayed
+by the node over a Unix socket (see relay.py).
+
+    python cluster.py --workers=0 --broker=redis    # one worker per core
+
+It takes the options of the cyclone-sse-server twistd plugin, and:
+
+- SIGHUP restarts the workers one after the other: the next worker is only
+  replaced once the previous one has exited. The clients of a worker being
+  restarted are disconnected over the drain timeout, and reconnect to the
+  other workers with their Last-Event-ID.
+- SIGTERM and SIGINT stop the workers and exit.
+
+A worker which dies is started again.
+"""
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.python import log, reflect
+
+from relay import NodeAmqpBroker, NodeHttpBroker, NodeRedisBroker
+from relay import RelayServerFactory
+from server import Options as ServerOptions
+
+# a worker which dies sooner than this after being started is started again
+# after the same delay, so a broken worker doesn't make the node spin.
+RESPAWN_DELAY = 1.0
+
+NODE_BROKERS = {'http': NodeHttpBroker,
+                'redis': NodeRedisBroker,
+                'amqp': NodeAmqpBroker}
+
+
+class Options(ServerOptions):
+    optParameters = [
+        ["workers", "w", 0, "number of workers, 0 for one per core", int],
+        ["drain-timeout", None, 10,
+         "seconds a stopping worker takes to disconnect its clients", int],
+        ["relay-socket", None, None,
+         "path of the Unix socket of the node, a temporary one by default"],
+        ["worker-fd", None, None,
+         "listening socket inherited from the node (internal)", int],
+        ["worker-index", None, None,
+         "index of the worker in its metrics export path (internal)", int],
+    ]
+
+
+def worker_count(workers):
+    if workers > 0:
+        return workers
+    return multiprocessing.cpu_count()
+
+
+def address_family(interface):
+    return socket.AF_INET6 if ':' in interface else socket.AF_INET
+
+
+def listen_socket(port, interface, backlog=1024):
+    """ Returns a listening socket, to be shared by the workers. """
+    sock = socket.socket(address_family(interface), socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+@defer.inlineCallbacks
+def drain(port, broker, timeout):
+    """ Stops accepting connections, then disconnects the clients a batch
+    at a time over `timeout` seconds, so that they don't all reconnect to
+    the other workers at once.
+
+    :param port: the listening port.
+    :param broker: the broker of the worker.
+    :param timeout: the number of seconds to disconnect the clients over.
+    """
+    yield port.stopListening()
+    clients = list(broker._clients.values())
+    steps = max(int(timeout / 0.1), 1)
+    batch = len(clients) // steps + 1
+    for i in range(0, len(clients), batch):
+        for client in clients[i:i + batch]:
+            stream = getattr(client, 'stream', None)
+            if stream is not None:
+                stream.paused = False
+                stream.flush()
+            client.transport.loseConnection()
+        yield task.deferLater(reactor, 0.1, lambda: None)
+
+
+def serve_worker(options):
+    """ Serves the application on the socket inherited from the node. """
+    application = reflect.namedAny(options["app"] or "server.App")(options)
+    fd = options["worker-fd"]
+    port = reactor.adoptStreamPort(fd, address_family(options["listen"]),
+                                   application)
+    # the reactor uses its own duplicate of the descriptor.
+    os.close(fd)
+
+    # the node handles SIGHUP, and a terminal hangup reaches the whole
+    # process group.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if application.metrics_export is not None:
+        # the replacement of the worker exports under the same path.
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      application.metrics_export.stop)
+    reactor.addSystemEventTrigger('before', 'shutdown', drain, port,
+                                  application.broker,
+                                  options["drain-timeout"])
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """ The node side of a worker process. """
+    def __init__(self, node, index):
+        self.node = node
+        self.index = index
+        self.started = time.time()
+        self.retired = False
+        self.ended = defer.Deferred()
+
+    def signal(self, name):
+        try:
+            self.transport.signalProcess(name)
+        except Exception:
+            # the process has already exited.
+            pass
+
+    def processEnded(self, reason):
+        self.node.worker_ended(self, reason)
+        self.ended.callback(None)
+
+
+class Node(object):
+    """ Holds the broker connection and keeps the workers running.
+
+    :param options: the parsed command line options.
+    :param argv: the command line to start a worker with, the socket
+                 descriptors are appended to it.
+    """
+    def __init__(self, options, argv):
+        self.count = worker_count(options["workers"])
+        self.drain_timeout = options["drain-timeout"]
+        self.relay_path = options["relay-socket"] or os.path.join(
+            tempfile.gettempdir(), 'cyclone-sse-%d.sock' % os.getpid())
+        self.argv = argv + ['--relay-socket', self.relay_path]
+        self.socket = listen_socket(options["port"], options["listen"])
+        self.broker = NODE_BROKERS[options["broker"]](options)
+        self.workers = set()
+        self.stopping = self.restarting = False
+
+    def start(self):
+        if os.path.exists(self.relay_path):
+            os.unlink(self.relay_path)
+        self.relay = reactor.listenUNIX(self.relay_path,
+                                        RelayServerFactory(self.broker),
+                                        mode=0o600)
+        for index in range(self.count):
+            self.spawn(index)
+        signal.signal(signal.SIGHUP,
+                      lambda *args: reactor.callFromThread(self.restart))
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        log.msg('node relaying to %d workers on %s' % (self.count,
+                                                       self.relay_path))
+
+    def spawn(self, index):
+        """ Starts a worker. A worker replacing another one gets its index,
+        and so exports its metrics under the same path.
+        """
+        fd = self.socket.fileno()
+        worker = WorkerProtocol(self, index)
+        reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable] + self.argv + ['--worker-fd', str(fd),
+                                            '--worker-index', str(index)],
+            env=os.environ, childFDs={0: 0, 1: 1, 2: 2, fd: fd})
+        self.workers.add(worker)
+        log.msg('worker %d started' % worker.transport.pid)
+        return worker
+
+    def worker_ended(self, worker, reason):
+        self.workers.discard(worker)
+        if worker.retired or self.stopping:
+            return
+        log.msg('worker exited unexpectedly: %s' % reason.getErrorMessage())
+        if time.time() - worker.started < RESPAWN_DELAY:
+            reactor.callLater(RESPAWN_DELAY, self._respawn, worker.index)
+        else:
+            self.spawn(worker.index)
+
+    def _respawn(self, index):
+        if not self.stopping:
+            self.spawn(index)
+
+    def retire(self, worker):
+        """ Asks a worker to disconnect its clients and exit, killing it if
+        it is still running after the drain timeout.
+        """
+        worker.retired = True
+        worker.signal('TERM')
+        kill = reactor.callLater(self.drain_timeout + 5, worker.signal,
+                                 'KILL')
+        worker.ended.addCallback(
+            lambda _: kill.cancel() if kill.active() else None)
+        return worker.ended
+
+    @defer.inlineCallbacks
+    def restart(self):
+        """ Replaces the workers one at a time: a new worker is started and
+        given RESPAWN_DELAY seconds to come up, then the old one is retired,
+        and the next one waits until it has exited.
+        """
+        if self.restarting:
+            log.msg('already restarting the workers')
+            return
+        self.restarting = True
+        try:
+            workers = [worker for worker in self.workers if not worker.retired]
+            log.msg('restarting %d workers' % len(workers))
+            for worker in workers:
+                if self.stopping:
+                    break
+                if worker not in self.workers:
+                    # it died meanwhile, and was started again.
+                    continue
+                self.spawn(worker.index)
+                yield task.deferLater(reactor, RESPAWN_DELAY, lambda: None)
+                if self.stopping:
+                    break
+                yield self.retire(worker)
+            else:
+                log.msg('restarted the workers')
+        finally:
+            self.restarting = False
+
+    @defer.inlineCallbacks
+    def stop(self):
+        self.stopping = True
+        yield defer.DeferredList(
+            [worker.ended if worker.retired else self.retire(worker)
+             for worker in list(self.workers)])
+        # removes the socket file.
+        yield self.relay.stopListening()
+
+
+def main():
+    options = Options()
+    try:
+        options.parseOptions()
+    except Exception as e:
+        sys.exit('%s\n%s' % (options, e))
+    log.startLogging(sys.stdout)
+    if options["worker-fd"] is None:
+        Node(options, sys.argv).start()
+    else:
+        serve_worker(options)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+""" Batched fan-out of the broker messages to the SSE clients.
+
+Every message is formatted once into an SSE frame whose bytes are shared by
+all the subscribers of its channel. The frames are not written right away:
+each connection collects them for a short window and gets them in a single
+write, so a burst costs one write per connection instead of one per event.
+
+A frame which is still pending when a newer event with the same key comes
+in is dropped, which is what keeps slow consumers, whose transport pauses
+them, from falling further and further behind. The frames pending for a
+client are bounded all the same: when its queue is full, the overflow
+policy drops the oldest frame, keeps only the latest one, or drops the
+client.
+"""
+from collections import OrderedDict
+import itertools
+import json
+import time
+
+import cyclone.web
+from cyclone_sse import brokers
+from cyclone_sse.handlers import BroadcastHandler
+from cyclone_sse.handlers import StatsHandler
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from zope.interface import implementer
+
+from metrics import Metrics
+from replay import REPLAY_CHANNELS, REPLAY_RETENTION, REPLAY_SIZE
+from replay import Redeliveries, ReplayBuffer
+from router import ChannelRouter
+
+# seconds the frames of a connection are collected for before being
+# written, 0 to write them right away.
+COALESCE_WINDOW = 0.01
+
+# the field of JSON messages whose value identifies the events superseding
+# each other, within a channel.
+KEY_FIELD = 'key'
+
+PING_INTERVAL = 30
+
+# frames pending per client, and what happens to the ones coming in once
+# that many are: 'drop-oldest', 'latest' (only the new one is kept) or
+# 'drop-client' (the connection is closed, the client reconnects with its
+# Last-Event-ID).
+QUEUE_SIZE = 1000
+OVERFLOW_POLICY = 'drop-oldest'
+OVERFLOW_POLICIES = ('drop-oldest', 'latest', 'drop-client')
+
+
+def format_event(message, eid=None, event=None):
+    """ Returns the SSE frame of a message, as bytes.
+
+    :param message: the message, a string or a dict to be sent as JSON.
+    :param eid: the event id, sent back by reconnecting clients.
+    :param event: the event type.
+    """
+    if isinstance(message, dict):
+        message = json.dumps(message)
+    if not isinstance(message, bytes):
+        message = message.encode('utf-8')
+    lines = []
+    if eid:
+        lines.append(b'id: ' + eid.encode('ascii'))
+    if event:
+        lines.append(b'event: ' + event.encode('utf-8'))
+    # a data field per line, the client joins them back.
+    lines.extend(b'data: ' + line for line in message.split(b'\n'))
+    return b'\n'.join(lines) + b'\n\n'
+
+
+@implementer(IPushProducer)
+class ClientStream(object):
+    """ The frames waiting to be written to a client. Registered as the
+    producer of the connection, it stops writing while the transport
+    buffer is full.
+
+    :param client: the :class:`StreamingBroadcastHandler` of the client.
+    :param broker: the broker scheduling the writes.
+    """
+    def __init__(self, client, broker):
+        self.client = client
+        self.broker = broker
+        self.transport = client.transport
+        # frames by key, unique integers for the frames without one.
+        self.pending = OrderedDict()
+        self._ids = itertools.count()
+        self.paused = False
+        self.closed = False
+
+    def push(self, frame, key=None):
+        """ Queues a frame, dropping the pending one of the same key. """
+        if self.closed:
+            return
+        if key is None:
+            key = next(self._ids)
+        elif self.pending.pop(key, None) is not None:
+            self.broker.counters['superseded'] += 1
+        if len(self.pending) >= self.broker.queue_size:
+            self.overflow()
+            if self.closed:
+                return
+        self.pending[key] = frame
+
+    def overflow(self):
+        policy = self.broker.overflow_policy
+        if policy == 'drop-client':
+            self.broker.counters['disconnected'] += 1
+            self.close()
+            return
+        if policy == 'latest':
+            dropped = len(self.pending)
+            self.pending.clear()
+        else:
+            self.pending.popitem(last=False)
+            dropped = 1
+        self.broker.counters['dropped'] += dropped
+
+    def close(self):
+        """ Drops the pending frames and the connection, whatever the
+        transport still buffers for it.
+        """
+        self.closed = True
+        self.pending.clear()
+        abort = getattr(self.transport, 'abortConnection', None)
+        if abort is not None:
+            abort()
+        else:
+            self.transport.loseConnection()
+
+    def flush(self):
+        if self.paused or self.closed or not self.pending:
+            return
+        data = b''.join(self.pending.values())
+        self.pending.clear()
+        self.transport.write(data)
+        self.broker.metrics.written(data)
+        self.client.reset_ping()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.broker.schedule(self)
+
+    def stopProducing(self):
+        # the connection is gone.
+        self.closed = True
+        self.pending.clear()
+
+
+class StreamingBroadcastHandler(BroadcastHandler):
+    """ Broadcast handler of the brokers using :class:`FanoutMixin`. """
+    @defer.inlineCallbacks
+    def bind(self):
+        auth = yield self.authorize()
+        if not auth:
+            raise cyclone.web.HTTPError(401)
+        broker = self.application.broker
+        broker.add_client(self)
+        self.flush()
+        self.write('\n\n')
+        self.flush()
+        # the status line and the headers are out, the events can follow.
+        broker.replay_missed(self)
+    def reset_ping(self):
+        # way cheaper than cancelling the call and scheduling a new one.
+        ping = getattr(self, 'ping', None)
+        if ping is not None and ping.active():
+            ping.reset(PING_INTERVAL)
+        else:
+            self.set_ping()
+
+
+class FanoutMixin(object):
+    """ Broker mixin formatting every message once and coalescing the
+    writes to each client. The `coalesce-window` (in seconds), `queue-size`
+    and `overflow-policy` settings override `COALESCE_WINDOW`,
+    `QUEUE_SIZE` and `OVERFLOW_POLICY`, and the `replay-size`,
+    `replay-retention` and `replay-channels` ones the defaults of
+    :class:`replay.ReplayBuffer`: they are options of
+    :class:`server.Options`.
+    """
+    def setup(self, settings):
+        self.coalesce_window = settings.get('coalesce-window',
+                                            COALESCE_WINDOW)
+        self.queue_size = settings.get('queue-size', QUEUE_SIZE)
+        self.overflow_policy = settings.get('overflow-policy',
+                                            OVERFLOW_POLICY)
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy %s' %
+                             self.overflow_policy)
+        # frames dropped by the overflow policy or superseded, and clients
+        # dropped, since startup.
+        self.counters = {'dropped': 0, 'superseded': 0, 'disconnected': 0}
+        self.metrics = Metrics(self)
+        self.router = ChannelRouter()
+        self.replay = ReplayBuffer(
+            settings.get('replay-size', REPLAY_SIZE),
+            settings.get('replay-retention', REPLAY_RETENTION),
+            settings.get('replay-channels', REPLAY_CHANNELS))
+        if self.replay.size:
+            task.LoopingCall(self.replay.expire).start(
+                max(self.replay.retention / 10.0, 1), now=False)
+        self._redeliveries = Redeliveries()
+        # the channels without clients whose events keep being buffered.
+        self._lingering = {}
+        self._dirty = set()
+        self._flush_call = None
+        self._window_started = None
+        super(FanoutMixin, self).setup(settings)
+
+    def add_client(self, client):
+        client.stream = ClientStream(client, self)
+        super(FanoutMixin, self).add_client(client)
+        for channel in client.channels:
+            self.router.add(channel, client)
+        client.transport.registerProducer(client.stream, True)
+        self.metrics.connections += 1
+
+    def remove_client(self, client):
+        stream = getattr(client, 'stream', None)
+        if stream is not None:
+            self._dirty.discard(stream)
+            # what is still pending goes out before the connection ends.
+            stream.paused = False
+            stream.flush()
+            client.transport.unregisterProducer()
+            client.stream = None
+            for channel in client.channels:
+                self.router.remove(channel, client)
+            self.metrics.disconnections += 1
+        super(FanoutMixin, self).remove_client(client)
+
+    def _subscribe(self, channel):
+        call = self._lingering.pop(channel, None)
+        if call is not None:
+            call.cancel()
+        super(FanoutMixin, self)._subscribe(channel)
+
+    def _unsubscribe(self, channel):
+        # clients reconnecting to a channel find the events they missed
+        # if it was kept subscribed for the retention time.
+        if not self.replay.size:
+            super(FanoutMixin, self)._unsubscribe(channel)
+        elif channel not in self._lingering:
+            self._lingering[channel] = reactor.callLater(
+                self.replay.retention, self._stop_lingering, channel)
+
+    def _stop_lingering(self, channel):
+        del self._lingering[channel]
+        if not self._channels.get(channel):
+            super(FanoutMixin, self)._unsubscribe(channel)
+
+    def send_cache(self, client):
+        # called by add_client, before the handler has sent its headers:
+        # see replay_missed.
+        pass
+
+    def replay_missed(self, client):
+        """ Sends a reconnecting client the events it missed, or a `resync`
+        event when they can't all be replayed: some are gone, or there are
+        more of them than its queue holds.
+        """
+        last_event_id = client.request.headers.get('Last-Event-Id', None)
+        if not last_event_id:
+            return
+        frames = self.replay.since(client.channels, last_event_id)
+        if frames is not None and len(frames) > self.queue_size:
+            # the overflow policy would eat part of the replay, or the
+            # client, on every reconnection.
+            frames = None
+        if frames is None:
+            self.replay.resyncs += 1
+            frames = [format_event('resync', self.replay.last_id(),
+                                   'resync')]
+        else:
+            self.replay.replayed += len(frames)
+        for frame in frames:
+            self.send_frame(client, frame)
+            if client.is_xhr():
+                break
+
+    def queue_stats(self):
+        """ Returns the depth of the client queues and the overflow
+        counters.
+        """
+        depths = [len(client.stream.pending)
+                  for client in self._clients.values()
+                  if getattr(client, 'stream', None) is not None]
+        stats = {'clients': len(depths),
+                 'queued': sum(depths),
+                 'max_depth': max(depths) if depths else 0,
+                 'queue_size': self.queue_size,
+                 'overflow_policy': self.overflow_policy}
+        stats.update(self.counters)
+        return stats
+
+    def broadcast(self, pattern, channel, message, seq=None):
+        """ Sends a message to all the clients of a channel.
+
+        :param seq: the sequence number of the event, when given by the
+                    cluster node.
+        """
+        if self.is_pattern_blocked(pattern):
+            return True
+        started = time.time()
+        frame = self._frame(pattern, channel, message, seq)
+        if frame is None:
+            # Redis sends a message once per subscription matching it: the
+            # clients of all of them got it the first time.
+            return
+        clients = self.route(pattern, channel)
+        if not clients:
+            return
+
+        log.msg('BROADCASTING to %s clients: pattern: %s, channel: %s' % (
+            len(clients), pattern, channel))
+        key = self.event_key(channel, message)
+        for client in clients:
+            # XMLHttpRequest clients are gone after their first event.
+            if client.stream is not None:
+                self.send_frame(client, frame, key)
+        self.metrics.deliveries += len(clients)
+        if not self.coalesce_window:
+            self.metrics.fanout.record(time.time() - started)
+
+    def _frame(self, pattern, channel, message, seq=None):
+        """ Returns the frame of a message, a new event kept for replay,
+        or `None` when Redis sends the same message again.
+        """
+        if self._redeliveries.get(pattern, channel, message) is not None:
+            return None
+        self.metrics.message(channel)
+        seq, eid = self.replay.next_id(seq)
+        frame = format_event(message, eid)
+        self.replay.add(channel, seq, frame)
+        self._redeliveries.record(pattern, channel, message, frame)
+        return frame
+
+    def route(self, pattern, channel):
+        """ Returns the clients a message of a channel goes to. """
+        return self.router.match(channel)
+
+    def event_key(self, channel, message):
+        """ Returns the key of the events a message supersedes, `None` for
+        none: the `KEY_FIELD` of JSON object messages, within their channel.
+        """
+        if message[:1] not in ('{', b'{'):
+            return None
+        try:
+            key = json.loads(message).get(KEY_FIELD)
+        except (ValueError, AttributeError):
+            return None
+        if key is None or isinstance(key, (dict, list)):
+            return None
+        return channel, key
+
+    def send_event(self, client, message, eid):
+        self.send_frame(client, format_event(message, eid))
+
+    def send_frame(self, client, frame, key=None):
+        """ Queues a formatted frame for a client. """
+        if client.is_xhr():
+            # their connection ends with the event.
+            client.transport.write(frame)
+            self.metrics.written(frame)
+            client.unbind()
+            return
+        client.stream.push(frame, key)
+        self.schedule(client.stream)
+
+    def schedule(self, stream):
+        """ Has the frames of a stream written at the end of the window. """
+        if not self.coalesce_window:
+            stream.flush()
+            return
+        self._dirty.add(stream)
+        if self._flush_call is None:
+            self._window_started = time.time()
+            self._flush_call = reactor.callLater(self.coalesce_window,
+                                                 self._flush)
+
+    def _flush(self):
+        self._flush_call = None
+        dirty, self._dirty = self._dirty, set()
+        for stream in dirty:
+            stream.flush()
+        # the wait of the first frame of the window, writes included.
+        self.metrics.fanout.record(time.time() - self._window_started)
+
+
+class QueueStatsHandler(StatsHandler):
+    """ The clients of every channel, along with the state of the client
+    queues and of the replay buffer.
+    """
+    def get_stats(self):
+        broker = self.application.broker
+        self.set_header("Content-Type", "application/json")
+        return json.dumps({'channels': broker.stats(),
+                           'queues': broker.queue_stats(),
+                           'replay': broker.replay.stats()})
+
+
+class HttpBroker(FanoutMixin, brokers.HttpBroker):
+    def publish(self, channels, message):
+        # even without subscribers, the events are kept for the clients
+        # about to reconnect.
+        for channel in channels:
+            if self.replay.size or self.router.match(channel):
+                self.queue.put({'channel': channel, 'message': message})
+
+
+class RedisBroker(FanoutMixin, brokers.RedisBroker):
+    pass
+
+
+class AmqpBroker(FanoutMixin, brokers.AmqpBroker):
+    pass
@@ -0,0 +1,227 @@
+""" Metrics of the SSE server, aggregated in-process and exported in
+batches.
+
+The fan-out path only increments plain attributes and dict entries: the
+reactor runs it one message at a time, so nothing needs a lock. Every
+`export-interval` seconds the totals, the gauges and the summaries of the
+histograms go out over UDP, a few datagrams for all of them, to Graphite
+(``--export=graphite``, plaintext protocol) or statsd (``--export=statsd``).
+"""
+from bisect import bisect_left
+import re
+import time
+
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python import log
+
+# the busiest channels get their own message counter, the others share one.
+TOP_CHANNELS = 100
+
+# the largest datagram sent, below the usual MTU.
+DATAGRAM_SIZE = 1400
+
+_unsafe = re.compile(r'[^A-Za-z0-9_-]')
+
+
+def log_linear_bounds(lowest, highest, sub_buckets):
+    """ Returns the upper bounds of buckets splitting every power of two
+    from `lowest` up to `highest` into `sub_buckets` buckets of the same
+    width.
+    """
+    bounds = [lowest]
+    base = lowest
+    while base < highest:
+        step = base / sub_buckets
+        bounds.extend(base + step * i for i in range(1, sub_buckets + 1))
+        base *= 2
+    return bounds
+
+
+# from 10us to about a minute, in seconds.
+BOUNDS = log_linear_bounds(0.00001, 60.0, 4)
+
+
+class Histogram(object):
+    """ Counts of the recorded values per bucket. """
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        # the last one counts the values above the highest bound.
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """ Returns the upper bound of the bucket holding the given
+        percentile of the values.
+        """
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return 0.0
+
+    def summary(self):
+        """ Returns the summary of the values recorded, in milliseconds. """
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean': self.sum / self.count * 1000,
+                'p50': self.percentile(50) * 1000,
+                'p99': self.percentile(99) * 1000,
+                'max': self.max * 1000}
+
+
+class Metrics(object):
+    """ The metrics of a broker, since the last export.
+
+    :param broker: the broker, read for the gauges and its `counters`.
+    """
+    def __init__(self, broker):
+        self.broker = broker
+        self.connections = 0
+        self.disconnections = 0
+        # messages coming in, frames queued for clients, writes and bytes
+        # going out.
+        self.messages = 0
+        self.deliveries = 0
+        self.writes = 0
+        self.bytes = 0
+        self.channels = {}
+        # from a message coming in to its frames being written.
+        self.fanout = Histogram()
+        self._counters = {}
+
+    def message(self, channel):
+        self.messages += 1
+        channels = self.channels
+        channels[channel] = channels.get(channel, 0) + 1
+
+    def written(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+    def collect(self):
+        """ Returns the (name, value, type) of every metric, type being 'c'
+        for the counters, reset by the export, and 'g' for the gauges.
+        """
+        metrics = [(name, getattr(self, name), 'c') for name in (
+            'connections', 'disconnections', 'messages', 'deliveries',
+            'writes', 'bytes')]
+        self.connections = self.disconnections = self.messages = 0
+        self.deliveries = self.writes = self.bytes = 0
+
+        channels, self.channels = self.channels, {}
+        ranked = sorted(channels.items(), key=lambda item: -item[1])
+        for channel, count in ranked[:TOP_CHANNELS]:
+            metrics.append(('channels.%s' % _unsafe.sub('_', channel), count,
+                            'c'))
+        others = sum(count for _, count in ranked[TOP_CHANNELS:])
+        if others:
+            metrics.append(('channels._others', others, 'c'))
+
+        # the broker counters only ever grow.
+        for name, total in sorted(self.broker.counters.items()):
+            metrics.append((name, total - self._counters.get(name, 0), 'c'))
+            self._counters[name] = total
+
+        for name, value in sorted(self.fanout.summary().items()):
+            metrics.append(('fanout_ms.%s' % name, value, 'g'))
+        self.fanout.reset()
+
+        queues = self.broker.queue_stats()
+        metrics.extend([('clients', len(self.broker._clients), 'g'),
+                        ('subscriptions', len(self.broker._channels), 'g'),
+                        ('queued', queues['queued'], 'g'),
+                        ('max_queue_depth', queues['max_depth'], 'g')])
+        return metrics
+
+
+def graphite_lines(metrics, prefix, timestamp):
+    return ['%s%s %s %d' % (prefix, name, value, timestamp)
+            for name, value, _ in metrics]
+
+
+def statsd_lines(metrics, prefix, timestamp):
+    return ['%s%s:%s|%s' % (prefix, name, value, kind)
+            for name, value, kind in metrics]
+
+
+class MetricsExport(DatagramProtocol):
+    """ Sends the metrics of a broker every `export-interval` seconds, to
+    the `export-host` and `export-port` Graphite or statsd server, under
+    `export-path`. The workers of cluster.py export under a path of their
+    own, `export-path` followed by ``worker<index>``: Graphite keeps only
+    the last value sent for a path.
+
+    :param metrics: the :class:`Metrics` of the broker.
+    :param settings: the server settings.
+    """
+    formats = {'graphite': graphite_lines, 'statsd': statsd_lines}
+
+    def __init__(self, metrics, settings):
+        self.metrics = metrics
+        self.format = self.formats[settings['export']]
+        self.host = settings['export-host']
+        self.port = settings['export-port']
+        self.interval = settings['export-interval']
+        self.prefix = settings['export-path']
+        if not self.host or not self.port:
+            raise ValueError('the metrics export needs --export-host and '
+                             '--export-port')
+        if self.prefix and not self.prefix.endswith('.'):
+            self.prefix += '.'
+        if settings.get('worker-index') is not None:
+            self.prefix += 'worker%d.' % settings['worker-index']
+        reactor.listenUDP(0, self)
+
+    def startProtocol(self):
+        self.transport.connect(self.host, self.port)
+        self.loop = task.LoopingCall(self.export)
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def export(self):
+        lines = self.format(self.metrics.collect(), self.prefix,
+                            int(time.time()))
+        for datagram in self.datagrams(lines):
+            try:
+                self.transport.write(datagram)
+            except Exception as e:
+                # nobody listening, or a full buffer: that batch is lost.
+                log.msg('could not export the metrics: %s' % e)
+                return
+
+    def datagrams(self, lines):
+        """ Packs the lines into as few datagrams as possible. """
+        datagram, size = [], 0
+        for line in lines:
+            line = line.encode('utf-8') + b'\n'
+            if datagram and size + len(line) > DATAGRAM_SIZE:
+                yield b''.join(datagram)
+                datagram, size = [], 0
+            datagram.append(line)
+            size += len(line)
+        if datagram:
+            yield b''.join(datagram)
+
+    def connectionRefused(self):
+        # the server is not up yet, the next batches may get through.
+        pass
@@ -0,0 +1,180 @@
+""" Relay of the broker messages from a cluster node to its workers.
+
+The node holds the only broker connection of the box. Its workers connect
+to it over a Unix socket, tell it the channels their clients subscribe to
+and the messages they get published, and get every message the node
+receives, numbered by the node: the event ids being the same in every
+worker, a client reconnecting to another worker gets the events it missed
+all the same, unless that worker was started after them.
+
+Commands are JSON lists, one per length-prefixed string:
+
+- worker to node: ``["subscribe", channel]``, ``["unsubscribe", channel]``,
+  ``["publish", channels, message]``.
+- node to worker: ``["hello", boot, seq]``, once connected, and
+  ``["event", seq, channel, message]``.
+"""
+import itertools
+import json
+
+from cyclone_sse import brokers
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+from fanout import FanoutMixin
+from replay import Redeliveries, ReplayBuffer
+
+MAX_LENGTH = 16 * 1024 * 1024
+
+
+def encode(*command):
+    return json.dumps(command).encode('utf-8')
+
+
+class WorkerConnection(Int32StringReceiver):
+    """ The node side of the connection of a worker. """
+    MAX_LENGTH = MAX_LENGTH
+
+    def connectionMade(self):
+        self.broker = self.factory.broker
+        self.uid = next(self.factory.ids)
+        self.channels = set()
+        self.broker.workers.add(self)
+        self.sendString(encode('hello', self.broker.replay.boot,
+                               self.broker.replay.seq))
+
+    def stringReceived(self, data):
+        command = json.loads(data)
+        if command[0] == 'subscribe':
+            self.broker.worker_subscribe(self, command[1])
+        elif command[0] == 'unsubscribe':
+            self.broker.worker_unsubscribe(self, command[1])
+        elif command[0] == 'publish':
+            self.broker.publish(command[1], command[2])
+        else:
+            log.msg('unknown command from worker %d: %r' % (self.uid,
+                                                           command[0]))
+
+    def connectionLost(self, reason):
+        self.broker.workers.discard(self)
+        for channel in list(self.channels):
+            self.broker.worker_unsubscribe(self, channel)
+
+
+class RelayServerFactory(protocol.ServerFactory):
+    protocol = WorkerConnection
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.ids = itertools.count()
+
+
+class NodeMixin(object):
+    """ Broker mixin of a cluster node: it subscribes to the channels its
+    workers have clients for, and relays them every message.
+    """
+    def setup(self, settings):
+        self.workers = set()
+        # numbers the events, nothing is kept.
+        self.replay = ReplayBuffer(size=0)
+        self._redeliveries = Redeliveries()
+        super(NodeMixin, self).setup(settings)
+
+    def worker_subscribe(self, worker, channel):
+        worker.channels.add(channel)
+        self._subscribe(channel)
+        self._channels[channel][worker.uid] = 1
+
+    def worker_unsubscribe(self, worker, channel):
+        worker.channels.discard(channel)
+        workers = self._channels.get(channel)
+        if workers is None:
+            return
+        workers.pop(worker.uid, None)
+        if not workers:
+            self._unsubscribe(channel)
+
+    def broadcast(self, pattern, channel, message):
+        """ Sends a message to every worker, encoded once. """
+        if self.is_pattern_blocked(pattern):
+            return True
+        if self._redeliveries.get(pattern, channel, message) is not None:
+            return
+        seq, _ = self.replay.next_id()
+        self._redeliveries.record(pattern, channel, message, seq)
+        data = encode('event', seq, channel, message)
+        for worker in self.workers:
+            worker.sendString(data)
+
+
+class NodeHttpBroker(NodeMixin, brokers.HttpBroker):
+    def publish(self, channels, message):
+        # the workers keep the events for their reconnecting clients.
+        for channel in channels:
+            self.queue.put({'channel': channel, 'message': message})
+
+
+class NodeRedisBroker(NodeMixin, brokers.RedisBroker):
+    pass
+
+
+class NodeAmqpBroker(NodeMixin, brokers.AmqpBroker):
+    pass
+
+
+class NodeConnection(Int32StringReceiver):
+    """ The worker side of the connection to the node. """
+    MAX_LENGTH = MAX_LENGTH
+
+    def connectionMade(self):
+        self.broker = self.factory.broker
+        self.broker._source = self
+        for channel in self.broker._channels:
+            self.broker._resubscribe(channel)
+
+    def stringReceived(self, data):
+        command = json.loads(data)
+        if command[0] == 'event':
+            _, seq, channel, message = command
+            self.broker.broadcast(None, channel, message, seq)
+        elif command[0] == 'hello':
+            # the ids of the events are the ones of the node, and the
+            # events it sent before are not buffered here.
+            _, boot, seq = command
+            replay = self.broker.replay
+            replay.boot = boot
+            replay.seq = replay.forgotten = seq
+
+    def command(self, *command):
+        self.sendString(encode(*command))
+
+    def connectionLost(self, reason):
+        self.broker._source = None
+        log.msg('lost the node: %s' % reason.getErrorMessage())
+        # nothing to serve without it, a running node starts another worker.
+        if reactor.running:
+            reactor.stop()
+
+
+class RelayBroker(FanoutMixin, brokers.Broker):
+    """ Broker of a cluster worker, getting its messages from the node
+    listening on the `relay-socket` Unix socket.
+    """
+    def connect(self, settings):
+        self.secret_key = settings['http-secret']
+        factory = protocol.ClientFactory()
+        factory.protocol = NodeConnection
+        factory.broker = self
+        reactor.connectUNIX(settings['relay-socket'], factory)
+
+    def subscribe(self, channel):
+        self._source.command('subscribe', channel)
+
+    def unsubscribe(self, channel):
+        self._source.command('unsubscribe', channel)
+
+    def publish(self, channels, message):
+        if self._source is not None:
+            self._source.command('publish', list(channels), message)
@@ -0,0 +1,163 @@
+""" Replay of the events a reconnecting SSE client missed.
+
+Every event gets an id made of the startup time of the server and a
+sequence number, and the last events of every channel are kept for a
+while. A client reconnecting with the id of the last event it got, in its
+Last-Event-ID header, gets the events of its channels which came after it.
+
+When some of them are not buffered anymore, or the id comes from another
+run of the server, the client gets a `resync` event instead: it has to
+reload the state it keeps some other way.
+"""
+from collections import OrderedDict, deque
+import time
+
+from router import is_pattern
+
+# events kept per channel, 0 to disable the replay.
+REPLAY_SIZE = 100
+# seconds events are kept for.
+REPLAY_RETENTION = 300
+# channels with buffered events, the least recently published ones are
+# forgotten first.
+REPLAY_CHANNELS = 100000
+
+
+def _matches(pattern, channel):
+    return pattern == '*' or channel.startswith(pattern[:-1])
+
+
+class ReplayBuffer(object):
+    """ The recent events of every channel, as formatted frames.
+
+    :param size: the number of events kept per channel.
+    :param retention: how long events are kept, in seconds.
+    :param max_channels: the number of channels whose events are kept.
+    """
+    def __init__(self, size=REPLAY_SIZE, retention=REPLAY_RETENTION,
+                 max_channels=REPLAY_CHANNELS):
+        self.size = size
+        self.retention = retention
+        self.max_channels = max_channels
+        self.boot = '%x' % int(time.time() * 1000)
+        self.seq = 0
+        # channel -> [sequence of the last event dropped, (seq, time, frame)
+        # deque], by least recent publication.
+        self.channels = OrderedDict()
+        # the last event dropped along with its whole channel.
+        self.forgotten = 0
+        self.replayed = 0
+        self.resyncs = 0
+
+    def next_id(self, seq=None):
+        """ Returns the sequence number and the id of a new event.
+
+        :param seq: the sequence number of the event when the cluster node
+                    numbers them.
+        """
+        self.seq = self.seq + 1 if seq is None else seq
+        return self.seq, self.last_id()
+
+    def last_id(self):
+        return '%s-%d' % (self.boot, self.seq)
+
+    def add(self, channel, seq, frame):
+        """ Keeps an event of a channel. """
+        if not self.size:
+            return
+        entry = self.channels.pop(channel, None)
+        if entry is None:
+            entry = [0, deque()]
+        self.channels[channel] = entry
+        events = entry[1]
+        if len(events) >= self.size:
+            entry[0] = events.popleft()[0]
+        events.append((seq, time.time(), frame))
+        while len(self.channels) > self.max_channels:
+            forgotten, events = self.channels.popitem(last=False)[1]
+            self.forgotten = max(self.forgotten, forgotten,
+                                 events[-1][0] if events else 0)
+
+    def expire(self):
+        """ Drops the events past their retention. """
+        deadline = time.time() - self.retention
+        for entry in self.channels.values():
+            events = entry[1]
+            while events and events[0][1] < deadline:
+                entry[0] = events.popleft()[0]
+
+    def since(self, subscriptions, last_event_id):
+        """ Returns the frames of the events after `last_event_id` on the
+        given channels and patterns, in order. Returns `None` when some of
+        them can't be replayed.
+
+        :param subscriptions: the channel names and patterns of a client.
+        :param last_event_id: the id of the last event the client got.
+        """
+        try:
+            boot, seq = last_event_id.rsplit('-', 1)
+            seq = int(seq)
+        except ValueError:
+            return None
+        if not self.size or boot != self.boot or seq > self.seq or \
+                seq < self.forgotten:
+            return None
+
+        names = set(channel for channel in subscriptions
+                    if not is_pattern(channel))
+        patterns = [channel for channel in subscriptions
+                    if is_pattern(channel)]
+        entries = [self.channels[name] for name in names
+                   if name in self.channels]
+        if patterns:
+            # patterns are rare enough for a scan of the channels to do.
+            entries.extend(entry for channel, entry in self.channels.items()
+                           if channel not in names and
+                           any(_matches(p, channel) for p in patterns))
+
+        deadline = time.time() - self.retention
+        missed = []
+        for forgotten, events in entries:
+            if seq < forgotten:
+                return None
+            for event_seq, at, frame in reversed(events):
+                if event_seq <= seq:
+                    break
+                if at < deadline:
+                    # expired, but never received.
+                    return None
+                missed.append((event_seq, frame))
+        missed.sort()
+        return [frame for _, frame in missed]
+
+    def stats(self):
+        return {'channels': len(self.channels),
+                'events': sum(len(events) for _, events
+                              in self.channels.values()),
+                'size': self.size,
+                'retention': self.retention,
+                'last_id': self.last_id(),
+                'replayed': self.replayed,
+                'resyncs': self.resyncs}
+
+
+class Redeliveries(object):
+    """ Tells the messages Redis sends again through another subscription:
+    it sends a message once per subscription matching it, all in a row.
+    """
+    def __init__(self):
+        self._last = None
+
+    def get(self, pattern, channel, message):
+        """ Returns what was recorded for the message if this is it again,
+        through another subscription, `None` otherwise.
+        """
+        last = self._last
+        if last is not None and last[0] == channel and \
+                last[1] == message and pattern not in last[2]:
+            last[2].add(pattern)
+            return last[3]
+        return None
+
+    def record(self, pattern, channel, message, value):
+        self._last = (channel, message, set([pattern]), value)
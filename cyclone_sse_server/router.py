@@ -0,0 +1,125 @@
+""" Routing of the messages of a channel to its subscribers.
+
+Clients subscribe to channel names, such as ``job.42``, and to channel
+patterns: ``*`` for every channel, or a prefix of dot-separated segments
+followed by ``.*``. ``job.*`` matches ``job.42`` and ``job.42.log``, not
+``job``.
+"""
+import re
+
+_channel = re.compile(r'^(\*|[A-Za-z0-9_:-]+(\.[A-Za-z0-9_:-]+)*(\.\*)?)\Z')
+
+
+def is_valid(channel):
+    """ Whether a channel name or pattern is well formed. """
+    return _channel.match(channel) is not None
+
+
+def is_pattern(channel):
+    return channel == '*' or channel.endswith('.*')
+
+
+def _prefix(pattern):
+    """ Returns the segments of the prefix of a pattern. """
+    return [] if pattern == '*' else pattern[:-2].split('.')
+
+
+class _Node(object):
+    __slots__ = ('children', 'clients')
+
+    def __init__(self):
+        self.children = {}
+        self.clients = set()
+
+
+class ChannelRouter(object):
+    """ The subscribers of every channel name and pattern. Names are
+    indexed in a dict and patterns in a trie of their segments, so that
+    matching a channel costs its number of segments plus its number of
+    subscribers, however many channels and patterns there are.
+    """
+    def __init__(self):
+        self._names = {}
+        self._root = _Node()
+
+    def add(self, channel, client):
+        """ Subscribes a client to a channel name or pattern. """
+        if not is_pattern(channel):
+            self._names.setdefault(channel, set()).add(client)
+            return
+        node = self._root
+        for segment in _prefix(channel):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _Node()
+            node = child
+        node.clients.add(client)
+
+    def remove(self, channel, client):
+        """ Unsubscribes a client from a channel name or pattern. Returns
+        whether the channel or pattern has no subscriber left.
+        """
+        if not is_pattern(channel):
+            clients = self._names.get(channel)
+            if clients is None:
+                return True
+            clients.discard(client)
+            if not clients:
+                del self._names[channel]
+                return True
+            return False
+
+        segments = _prefix(channel)
+        path = [self._root]
+        for segment in segments:
+            node = path[-1].children.get(segment)
+            if node is None:
+                return True
+            path.append(node)
+        path[-1].clients.discard(client)
+        empty = not path[-1].clients
+        # prunes the nodes which lead to no subscriber anymore.
+        for i in range(len(segments), 0, -1):
+            if path[i].clients or path[i].children:
+                break
+            del path[i - 1].children[segments[i - 1]]
+        return empty
+
+    def subscribers(self, channel):
+        """ Returns the clients subscribed to exactly this channel name or
+        pattern.
+        """
+        if not is_pattern(channel):
+            return self._names.get(channel, ())
+        node = self._root
+        for segment in _prefix(channel):
+            node = node.children.get(segment)
+            if node is None:
+                return ()
+        return node.clients
+
+    def match(self, channel):
+        """ Returns the clients of a channel, the ones of the patterns
+        matching it included, each one once.
+        """
+        matched = []
+        clients = self._names.get(channel)
+        if clients:
+            matched.append(clients)
+        node = self._root
+        if node.clients:
+            matched.append(node.clients)
+        # a pattern matches the channels with at least one more segment.
+        segments = channel.split('.')
+        for segment in segments[:-1]:
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.clients:
+                matched.append(node.clients)
+
+        if not matched:
+            return []
+        if len(matched) == 1:
+            return list(matched[0])
+        return list(set().union(*matched))
@@ -1,31 +1,116 @@
+from collections import OrderedDict
+import json
+
 import cyclone.web
 
-from cyclone_sse.handlers import BroadcastHandler
 from cyclone_sse.handlers import PublishHandler
-from cyclone_sse.handlers import StatsHandler
 
-from cyclone_sse.brokers import HttpBroker
-from cyclone_sse.brokers import RedisBroker
-from cyclone_sse.brokers import AmqpBroker
+from twisted.internet import defer
+from twisted.plugins.cyclonesse_plugin import Options as PluginOptions
+
+from fanout import COALESCE_WINDOW, OVERFLOW_POLICIES, OVERFLOW_POLICY
+from fanout import QUEUE_SIZE
+from fanout import QueueStatsHandler
+from fanout import StreamingBroadcastHandler
+from fanout import HttpBroker
+from fanout import RedisBroker
+from fanout import AmqpBroker
+from metrics import MetricsExport
+from relay import RelayBroker
+from replay import REPLAY_CHANNELS, REPLAY_RETENTION, REPLAY_SIZE
+from router import is_valid
+
+
+# channels of the clients which don't ask for any.
+DEFAULT_CHANNELS = ["base", "node"]
+MAX_CHANNELS = 100
+
+
+def overflow_policy(policy):
+    if policy not in OVERFLOW_POLICIES:
+        raise ValueError('not one of %s' % ', '.join(OVERFLOW_POLICIES))
+    return policy
+overflow_policy.coerceDoc = 'One of %s.' % ', '.join(OVERFLOW_POLICIES)
 
-from cyclone_sse.periodic import GraphiteExport
 
+class Options(PluginOptions):
+    """ The options of the cyclone-sse twistd plugin, and the ones of the
+    fan-out and of the replay. Used by the cyclone-sse-server plugin and
+    by cluster.py.
+    """
+    optParameters = [
+        ["coalesce-window", None, COALESCE_WINDOW,
+         "seconds the frames of a client are collected for, 0 to write "
+         "them right away", float],
+        ["queue-size", None, QUEUE_SIZE, "frames pending per client", int],
+        ["overflow-policy", None, OVERFLOW_POLICY,
+         "what happens to the frames of a client whose queue is full",
+         overflow_policy],
+        ["replay-size", None, REPLAY_SIZE,
+         "events kept per channel for the reconnecting clients, 0 to "
+         "disable the replay", int],
+        ["replay-retention", None, REPLAY_RETENTION,
+         "seconds events are kept for", int],
+        ["replay-channels", None, REPLAY_CHANNELS,
+         "channels whose events are kept", int],
+    ]
 
-class CustomBroadcastHandler(BroadcastHandler):
 
-    #def authorize(self):
-    #    #raise cyclone.web.HTTPAuthenticationRequired
-    #    pass
+class CustomBroadcastHandler(StreamingBroadcastHandler):
+
+    def authorize(self):
+        # the channel arguments get checked before anything is subscribed.
+        channels = self.get_channels()
+        if len(channels) > MAX_CHANNELS:
+            raise cyclone.web.HTTPError(400, 'too many channels')
+        for channel in channels:
+            if not is_valid(channel):
+                raise cyclone.web.HTTPError(400, 'invalid channel %s' %
+                                            channel)
+        return defer.succeed(all(self.can_subscribe(channel)
+                                 for channel in channels))
+
+    def can_subscribe(self, channel):
+        # e.g. checks a token against a per-job channel, a client failing
+        # it for any channel gets a 401.
+        return True
 
     def get_channels(self):
-        return ["base", "node"]
+        # ?channels=job.42,node.*&channels=base
+        if not hasattr(self, '_requested_channels'):
+            channels = []
+            for argument in self.get_arguments('channels'):
+                channels.extend(channel.strip() for channel
+                                in argument.split(',') if channel.strip())
+            self._requested_channels = \
+                list(OrderedDict.fromkeys(channels)) or DEFAULT_CHANNELS
+        return self._requested_channels
+
+
+class BatchPublishHandler(cyclone.web.RequestHandler):
+    """ Publishes a JSON array of [channel, message] pairs, e.g. the change
+    events of the REST server, with the same key as /publish.
+    """
+    def post(self):
+        broker = self.application.broker
+        if broker.secret_key and \
+                self.get_argument("key", None) != broker.secret_key:
+            raise cyclone.web.HTTPError(401)
+        try:
+            events = json.loads(self.request.body)
+            for channel, message in events:
+                broker.publish([channel], message)
+        except (TypeError, ValueError):
+            raise cyclone.web.HTTPError(400)
+        self.set_header("Content-Type", "application/json")
+        self.write({'status': 'ok', 'published': len(events)})
 
 
 class App(cyclone.web.Application):
     def __init__(self, settings):
         handlers = [
             (r"/", CustomBroadcastHandler),
-            (r"/stats", StatsHandler),
+            (r"/stats", QueueStatsHandler),
         ]
 
         if settings["broker"] == 'amqp':
@@ -35,10 +120,18 @@ class App(cyclone.web.Application):
         else:
             broker = HttpBroker
             handlers.append((r"/publish", PublishHandler))
+            handlers.append((r"/publish/batch", BatchPublishHandler))
+
+        if settings.get("relay-socket"):
+            # a worker of cluster.py, the node holds the broker connection.
+            broker = RelayBroker
 
         self.broker = broker(settings)
 
-        if settings['export'] and settings['export'] == 'graphite':
-            graphite = GraphiteExport(self.broker, settings)
+        if settings['export'] in MetricsExport.formats:
+            self.metrics_export = MetricsExport(self.broker.metrics,
+                                                settings)
+        else:
+            self.metrics_export = None
 
         cyclone.web.Application.__init__(self, handlers)
@@ -1 +1,5 @@
-twistd -n cyclone-sse -r "server.App" --broker=redis
+# the cyclone-sse-server plugin and server.App are found on the path.
+export PYTHONPATH=".${PYTHONPATH:+:$PYTHONPATH}"
+twistd -n cyclone-sse-server -p 8889 --broker=redis
+# one worker per core, sharing the Redis subscription:
+# python cluster.py --workers=0 -p 8889 --broker=redis
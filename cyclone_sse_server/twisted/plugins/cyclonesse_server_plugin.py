@@ -0,0 +1,26 @@
+""" The cyclone-sse-server twistd plugin: the cyclone-sse one, serving
+`server.App` by default and taking the options of :class:`server.Options`.
+
+    twistd -n cyclone-sse-server --broker=redis --queue-size=500
+"""
+from twisted.application.service import IServiceMaker
+from twisted.plugin import IPlugin
+from twisted.plugins.cyclonesse_plugin import ServiceMaker
+from zope.interface import implementer
+
+from server import Options
+
+
+@implementer(IServiceMaker, IPlugin)
+class ServerServiceMaker(ServiceMaker):
+    tapname = "cyclone-sse-server"
+    description = "SSE server with batched fan-out and event replay"
+    options = Options
+
+    def makeService(self, options):
+        if not options["app"]:
+            options["app"] = "server.App"
+        return ServiceMaker.makeService(self, options)
+
+
+serviceMaker = ServerServiceMaker()